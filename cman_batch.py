@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+import argparse
+import time
+import numpy as np
+from cman_game import Game, MAX_ATTEMPTS, WIN_SCORE, Player, State, Direction
+from cman_game_map import compile_map
+
+# Row and column offsets indexed by direction, the last entry serves Direction.NONE (-1)
+DIRECTION_ROWS = np.array([-1, 0, 1, 0, 0], dtype=np.int16)
+DIRECTION_COLS = np.array([0, -1, 0, 1, 0], dtype=np.int16)
+
+
+class BatchGame:
+    """
+    Runs many games of the same map in lockstep with the rules of cman_game.Game.
+
+    State is kept in arrays with one row per game: coordinates, lives, score,
+    state, winner and the collected points. step() applies one cman move and then
+    one spirit move to every game, exactly like a server tick applies them to a Game.
+    """
+    def __init__(self, map_path: str, games: int) -> None:
+        compiled = compile_map(map_path)
+        self.games = games
+        self.walkable = np.frombuffer(compiled.walkable, dtype=np.uint8).reshape(compiled.rows, compiled.cols).astype(bool)
+        self.point_ids = np.full((compiled.rows, compiled.cols), -1, dtype=np.int32)
+        for (i, j), index in compiled.point_index.items():
+            self.point_ids[i, j] = index
+        self.point_count = len(compiled.point_positions)
+        self.points_bytes_length = (self.point_count + 7) // 8
+        self.win_score = min(WIN_SCORE, self.point_count)
+        self.start_rows = np.array([coords[0] for coords in compiled.start_coords], dtype=np.int16)
+        self.start_cols = np.array([coords[1] for coords in compiled.start_coords], dtype=np.int16)
+        self.rows = np.empty((games, 2), dtype=np.int16)
+        self.cols = np.empty((games, 2), dtype=np.int16)
+        self.lives = np.empty(games, dtype=np.int8)
+        self.score = np.empty(games, dtype=np.int16)
+        self.state = np.empty(games, dtype=np.int8)
+        self.winner = np.empty(games, dtype=np.int8)
+        self.eaten = np.empty((games, self.point_count), dtype=bool)
+        self.restart(np.arange(games))
+
+    def restart(self, games: np.ndarray) -> None:
+        """
+        Restarts the given games to their initial values, like Game.restart_game.
+        """
+        self.rows[games] = self.start_rows
+        self.cols[games] = self.start_cols
+        self.lives[games] = MAX_ATTEMPTS
+        self.score[games] = 0
+        self.state[games] = State.WAIT
+        self.winner[games] = Player.NONE
+        self.eaten[games] = False
+
+    def declare_winner(self, games: np.ndarray, player: Player) -> None:
+        undecided = games[self.state[games] != State.WIN]
+        self.state[undecided] = State.WIN
+        self.winner[undecided] = player
+
+    def apply_move(self, player: Player, directions: np.ndarray) -> np.ndarray:
+        """
+        Applies one move of player in every game, directions holds a Direction per game.
+
+        Returns a boolean array telling in which games the state changed.
+        """
+        moving = directions != Direction.NONE
+        next_rows = self.rows[:, player] + DIRECTION_ROWS[directions]
+        next_cols = self.cols[:, player] + DIRECTION_COLS[directions]
+        height, width = self.walkable.shape
+        moved = moving & (next_rows >= 0) & (next_cols >= 0) & (next_rows < height) & (next_cols < width)
+        moved[moved] = self.walkable[next_rows[moved], next_cols[moved]]
+        games = np.flatnonzero(moved)
+        rows = next_rows[games]
+        cols = next_cols[games]
+        self.state[games] = State.PLAY
+        self.rows[games, player] = rows
+        self.cols[games, player] = cols
+        other = Player.SPIRIT if player == Player.CMAN else Player.CMAN
+        if player == Player.CMAN:
+            point_ids = self.point_ids[rows, cols]
+            on_point = point_ids >= 0
+            eating = games[on_point]
+            point_ids = point_ids[on_point]
+            self.score[eating] += ~self.eaten[eating, point_ids]
+            self.eaten[eating, point_ids] = True
+            self.declare_winner(eating[self.score[eating] >= self.win_score], Player.CMAN)
+        caught = games[(rows == self.rows[games, other]) & (cols == self.cols[games, other])]
+        self.lives[caught] -= 1
+        self.declare_winner(caught[self.lives[caught] <= 0], Player.SPIRIT)
+        next_round = caught[self.lives[caught] > 0]
+        self.rows[next_round] = self.start_rows
+        self.cols[next_round] = self.start_cols
+        self.state[next_round] = State.START
+        return moved
+
+    def step(self, cman_directions: np.ndarray, spirit_directions: np.ndarray) -> None:
+        self.apply_move(Player.CMAN, cman_directions)
+        self.apply_move(Player.SPIRIT, spirit_directions)
+
+    def get_winners(self) -> np.ndarray:
+        return np.where(self.state == State.WIN, self.winner, Player.NONE)
+
+    def get_points_bytes(self, game: int) -> bytes:
+        """
+        Returns the collected points of one game in the format of Game.get_points_bytes.
+        """
+        bits = np.zeros(self.points_bytes_length * 8, dtype=bool)
+        bits[:self.point_count] = self.eaten[game]
+        return np.packbits(bits).tobytes()
+
+
+def random_directions(rng: np.random.Generator, games: int) -> np.ndarray:
+    return rng.integers(Direction.NONE, Direction.RIGHT + 1, size=games).astype(np.int8)
+
+
+def check_parity(map_path: str, games: int, steps: int, seed: int) -> int:
+    """
+    Plays the same random moves on a BatchGame and on one Game per row and compares
+    the full state after every step. Returns the number of mismatching game states.
+    """
+    rng = np.random.default_rng(seed)
+    batch = BatchGame(map_path, games)
+    references = [Game(map_path) for _ in range(games)]
+    batch.state[:] = State.START
+    for game in references:
+        game.state = State.START
+    mismatches = 0
+    for step in range(steps):
+        cman_directions = random_directions(rng, games)
+        spirit_directions = random_directions(rng, games)
+        batch.step(cman_directions, spirit_directions)
+        winners = batch.get_winners()
+        for i, game in enumerate(references):
+            game.apply_move(Player.CMAN, int(cman_directions[i]))
+            game.apply_move(Player.SPIRIT, int(spirit_directions[i]))
+            expected = (game.get_current_players_coords(), game.get_game_progress(), game.state,
+                        game.get_winner(), game.get_points_bytes())
+            actual = ([(int(batch.rows[i, p]), int(batch.cols[i, p])) for p in (Player.CMAN, Player.SPIRIT)],
+                      (int(batch.lives[i]), int(batch.score[i])), int(batch.state[i]),
+                      int(winners[i]), batch.get_points_bytes(i))
+            if expected != actual:
+                mismatches += 1
+                print(f"Mismatch in game {i} at step {step}: expected {expected}, got {actual}")
+        finished = np.flatnonzero(winners != Player.NONE)
+        batch.restart(finished)
+        batch.state[finished] = State.START
+        for i in finished:
+            references[i].restart_game()
+            references[i].state = State.START
+    return mismatches
+
+
+def measure_throughput(map_path: str, games: int, steps: int, seed: int) -> float:
+    rng = np.random.default_rng(seed)
+    batch = BatchGame(map_path, games)
+    batch.state[:] = State.START
+    moves = [(random_directions(rng, games), random_directions(rng, games)) for _ in range(16)]
+    start = time.perf_counter()
+    for step in range(steps):
+        batch.step(*moves[step % len(moves)])
+        finished = np.flatnonzero(batch.state == State.WIN)
+        if finished.size:
+            batch.restart(finished)
+            batch.state[finished] = State.START
+    return games * steps / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless batch simulation of cman games.")
+    parser.add_argument("--map", type=str, default="map.txt", help="Map file (default: map.txt).")
+    parser.add_argument("--games", type=int, default=10000, help="Games run in lockstep (default: 10000).")
+    parser.add_argument("--steps", type=int, default=1000, help="Ticks to simulate (default: 1000).")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random moves (default: 0).")
+    parser.add_argument("--parity", action="store_true",
+                        help="Check every step against cman_game.Game instead of measuring throughput.")
+    args = parser.parse_args()
+    if args.parity:
+        mismatches = check_parity(args.map, args.games, args.steps, args.seed)
+        print(f"Parity check: {mismatches} mismatching states over {args.games} games and {args.steps} steps")
+        exit(1 if mismatches else 0)
+    rate = measure_throughput(args.map, args.games, args.steps, args.seed)
+    print(f"{rate:,.0f} game ticks per second")
@@ -0,0 +1,127 @@
+from array import array
+from collections import OrderedDict
+from typing import Optional
+from cman_game import Game, Player
+from cman_game_map import CompiledMap
+
+UNREACHABLE = 0xFFFF
+OPPOSITE = (2, 3, 0, 1) # down, right, up, left: the move that undoes up, left, down, right
+FLEE_DISTANCE = 2 # the cman bot runs from a spirit this close instead of collecting points
+PATH_CACHE_TARGETS = 256 # searches kept per map, each holds three bytes per walkable cell
+
+
+class PathTable:
+    """
+    Shortest path distances and first steps from every walkable cell of a map to a target,
+    found with one breadth-first search from the target the first time it is asked for.
+    The PATH_CACHE_TARGETS most recently used targets are kept, so memory grows with the
+    map size rather than its square, and a bot only searches again when its target moves.
+    """
+    def __init__(self, game_map: CompiledMap) -> None:
+        cells = list(game_map.moves)
+        self.index = {cell: k for k, cell in enumerate(cells)}
+        self.neighbours = [tuple((direction, self.index[target]) for direction, target
+                                 in enumerate(game_map.moves[cell]) if target is not None) for cell in cells]
+        self.searches: OrderedDict[int, tuple[array, bytearray]] = OrderedDict()
+
+    def search(self, target: int) -> tuple[array, bytearray]:
+        """
+        Returns the distances and first directions + 1 (0 where there is no move to make)
+        of every cell towards the cell with index target.
+        """
+        searches = self.searches
+        found = searches.get(target)
+        if found is not None:
+            searches.move_to_end(target)
+            return found
+        neighbours = self.neighbours
+        distances = array("H", [UNREACHABLE]) * len(neighbours)
+        steps = bytearray(len(neighbours))
+        distances[target] = 0
+        queue = [target]
+        for cell in queue:
+            distance = distances[cell] + 1
+            for direction, neighbour in neighbours[cell]:
+                if distances[neighbour] == UNREACHABLE:
+                    distances[neighbour] = distance
+                    steps[neighbour] = OPPOSITE[direction] + 1 # moves are symmetric, so go back the way we came
+                    queue.append(neighbour)
+        if len(searches) >= PATH_CACHE_TARGETS:
+            searches.popitem(last=False)
+        found = searches[target] = (distances, steps)
+        return found
+
+    def distance(self, source: tuple[int, int], target: tuple[int, int]) -> int:
+        return self.search(self.index[target])[0][self.index[source]]
+
+    def step(self, source: tuple[int, int], target: tuple[int, int]) -> int:
+        """
+        Returns the direction of the first move on a shortest path, or -1 when there is none.
+        """
+        return self.search(self.index[target])[1][self.index[source]] - 1
+
+    def nearest(self, source: tuple[int, int], targets: list[tuple[int, int]]) -> tuple[int, int]:
+        # Distances are symmetric, so one search from source ranks every target
+        distances = self.search(self.index[source])[0]
+        index = self.index
+        return min(targets, key=lambda cell: distances[index[cell]])
+
+
+_path_tables: dict[bytes, PathTable] = {}
+
+def path_table(game_map: CompiledMap) -> PathTable:
+    """
+    Returns the PathTable of a map, built the first time a map with this content is used.
+    """
+    table = _path_tables.get(game_map.digest)
+    if table is None:
+        table = _path_tables[game_map.digest] = PathTable(game_map)
+    return table
+
+
+class SpiritBot:
+    """
+    Chases cman along a shortest path.
+    """
+    def __init__(self, game_map: CompiledMap) -> None:
+        self.table = path_table(game_map)
+
+    def next_move(self, game: Game) -> int:
+        if not game.can_move(Player.SPIRIT):
+            return -1
+        return self.table.step(game.cur_coords[Player.SPIRIT], game.cur_coords[Player.CMAN])
+
+
+class CmanBot:
+    """
+    Walks to the nearest remaining point and keeps that target until it is eaten, so the
+    points are only searched once per point. Runs from the spirit when it gets close.
+    """
+    def __init__(self, game_map: CompiledMap) -> None:
+        self.table = path_table(game_map)
+        self.target: Optional[tuple[int, int]] = None
+
+    def next_move(self, game: Game) -> int:
+        if not game.can_move(Player.CMAN):
+            return -1
+        table = self.table
+        position = game.cur_coords[Player.CMAN]
+        spirit = game.cur_coords[Player.SPIRIT]
+        if table.distance(position, spirit) <= FLEE_DISTANCE:
+            return self.flee(game, position, spirit)
+        if self.target is None or not game.points[self.target]:
+            remaining = [point for point, value in game.points.items() if value]
+            if not remaining:
+                return -1
+            self.target = table.nearest(position, remaining)
+        return table.step(position, self.target)
+
+    def flee(self, game: Game, position: tuple[int, int], spirit: tuple[int, int]) -> int:
+        best, best_distance = -1, self.table.distance(position, spirit)
+        for direction, cell in enumerate(game.moves[position]):
+            if cell is not None and self.table.distance(cell, spirit) > best_distance:
+                best, best_distance = direction, self.table.distance(cell, spirit)
+        return best
+
+
+BOTS = {Player.CMAN: CmanBot, Player.SPIRIT: SpiritBot}
@@ -0,0 +1,222 @@
+import argparse
+import math
+import os
+import random
+import socket
+import struct
+from typing import Optional
+from cman_bots import BOTS
+from cman_game import MAX_ATTEMPTS, Player, State
+from cman_game_map import CompiledMap, compile_map
+from cman_session import ServerClient, Session, bot_client
+
+# File layout: header, then per ongoing match a session record, its points bitmap, its two
+# player records and its spectator records, then the queued players. Little endian throughout.
+CHECKPOINT_MAGIC = b"CMCP"
+CHECKPOINT_VERSION = 1
+HEADER = struct.Struct("<4sB32sHHH") # magic, version, map digest, next match id, sessions, queued players
+SESSION = struct.Struct("<HdBd4BHbBbHbbHHHHH")
+# match id, fps, immediate input mode, move rate, cman and spirit row/col, score, lives, state, winner,
+# tick seq, cman move, spirit move, input seqs, applied input seqs, spectator count
+PLAYER = struct.Struct("<B4sHB") # 0 for a bot 1 for a client, address, port, protocol version
+SPECTATOR = struct.Struct("<4sHBB") # address, port, protocol version, receives multicast
+QUEUED = struct.Struct("<4sHBB") # address, port, protocol version, role
+
+
+class CheckpointError(ValueError):
+    """
+    A checkpoint that is truncated or corrupted, as opposed to one written for another map or format.
+    """
+
+
+def player_record(client: ServerClient) -> bytes:
+    if client.bot is not None:
+        return PLAYER.pack(0, bytes(4), 0, client.version)
+    return PLAYER.pack(1, socket.inet_aton(client.address[0]), client.address[1], client.version)
+
+
+def session_record(session: Session) -> bytes:
+    """
+    Serializes an ongoing session. The points bitmap is the one Game caches between
+    collected points and the player and spectator records are cached on the session
+    until its members change, so an unchanged match mostly costs one struct pack.
+    """
+    game = session.game
+    (cman_row, cman_col), (spirit_row, spirit_col) = game.get_current_players_coords()
+    winner = game.winner if game.winner is not None else Player.NONE
+    header = SESSION.pack(session.match_id, session.fps, session.immediate, 1 / session.move_interval,
+                          cman_row, cman_col, spirit_row, spirit_col, game.score, game.lives, game.state, winner,
+                          session.tick_seq, session.cman_move, session.spirit_move, *session.input_seqs,
+                          *session.applied_seqs, len(session.spectators))
+    if session.checkpoint_members is None:
+        members = [player_record(session.cman_player), player_record(session.spirit_player)]
+        for client in session.spectators:
+            members.append(SPECTATOR.pack(socket.inet_aton(client.address[0]), client.address[1], client.version,
+                                          client.multicast))
+        session.checkpoint_members = b"".join(members)
+    return header + game.get_points_bytes() + session.checkpoint_members
+
+
+def encode(game_map: CompiledMap, next_match_id: int, sessions: list[Session], queued: list[ServerClient]) -> bytes:
+    records = [HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, game_map.digest, next_match_id,
+                           len(sessions), len(queued))]
+    records += [session_record(session) for session in sessions]
+    records += [QUEUED.pack(socket.inet_aton(client.address[0]), client.address[1], client.version, client.role)
+                for client in queued]
+    return b"".join(records)
+
+
+def write_file(path: str, data: bytes) -> None:
+    # Written next to the target and renamed, so a crash mid-write leaves the previous checkpoint
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+class Checkpoint:
+    """
+    A decoded checkpoint: sessions ready to resume ticking and the players that were still queued.
+    """
+    def __init__(self, next_match_id: int, sessions: list[Session], queued: list[ServerClient]) -> None:
+        self.next_match_id = next_match_id
+        self.sessions = sessions
+        self.queued = queued
+
+
+def read_player(data: bytes, offset: int, role: int, game_map: CompiledMap) -> ServerClient:
+    kind, address, port, version = PLAYER.unpack_from(data, offset)
+    if kind == 0:
+        client = bot_client(BOTS[role - 1](game_map), role, version)
+    else:
+        client = ServerClient((socket.inet_ntoa(address), port), role, version)
+    return client
+
+
+def check(condition: bool, message: str) -> None:
+    if not condition:
+        raise CheckpointError(message)
+
+
+def on_board(game_map: CompiledMap, coords: tuple[int, int]) -> bool:
+    return coords[0] < game_map.rows and coords[1] < game_map.cols and game_map.is_walkable(coords)
+
+
+def decode(data: bytes, map_path: str, game_map: CompiledMap) -> Optional[Checkpoint]:
+    """
+    Rebuilds the sessions of a checkpoint, or returns None when it was written for another map or format.
+    Raises CheckpointError when it is truncated or corrupted.
+    """
+    try:
+        return read_checkpoint(data, map_path, game_map)
+    except CheckpointError:
+        raise
+    except (struct.error, ValueError) as e: # struct.error when truncated, ValueError from State() and Player()
+        raise CheckpointError(str(e)) from e
+
+
+def read_checkpoint(data: bytes, map_path: str, game_map: CompiledMap) -> Optional[Checkpoint]:
+    magic, version, digest, next_match_id, session_count, queued_count = HEADER.unpack_from(data)
+    if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION or digest != game_map.digest:
+        return None
+    offset = HEADER.size
+    sessions = []
+    for _ in range(session_count):
+        (match_id, fps, immediate, move_rate, cman_row, cman_col, spirit_row, spirit_col, score, lives, state,
+         winner, tick_seq, cman_move, spirit_move, cman_input, spirit_input, cman_applied, spirit_applied,
+         spectator_count) = SESSION.unpack_from(data, offset)
+        offset += SESSION.size
+        check(math.isfinite(fps) and fps > 0 and math.isfinite(move_rate) and move_rate > 0,
+              f"match {match_id} has tick rate {fps} and move rate {move_rate}")
+        check(on_board(game_map, (cman_row, cman_col)) and on_board(game_map, (spirit_row, spirit_col)),
+              f"match {match_id} has a player off the board")
+        check(-1 <= cman_move < 4 and -1 <= spirit_move < 4, f"match {match_id} has a bad move")
+        players = []
+        bitmap_offset = offset
+        offset += (len(game_map.point_positions) + 7) // 8
+        for role in (1, 2):
+            players.append(read_player(data, offset, role, game_map))
+            offset += PLAYER.size
+        session = Session(match_id, players[0], players[1], map_path, fps, bool(immediate), move_rate)
+        game = session.game
+        game.set_points_bytes(data[bitmap_offset:bitmap_offset + game.points_bytes_length])
+        game.cur_coords = [(cman_row, cman_col), (spirit_row, spirit_col)]
+        game.score, game.lives, game.state = score, lives, State(state)
+        game.winner = Player(winner) if winner != Player.NONE else None
+        session.game_ongoing = True
+        session.tick_seq = tick_seq
+        session.cman_move, session.spirit_move = cman_move, spirit_move
+        session.input_seqs = [cman_input, spirit_input]
+        session.applied_seqs = [cman_applied, spirit_applied]
+        session.sent_coords = list(game.cur_coords)
+        session.sent_attempts = MAX_ATTEMPTS - lives
+        session.sent_eaten = len(game.get_eaten_points())
+        for _ in range(spectator_count):
+            address, port, client_version, multicast = SPECTATOR.unpack_from(data, offset)
+            offset += SPECTATOR.size
+            spectator = ServerClient((socket.inet_ntoa(address), port), 0, client_version)
+            session.add_spectator(spectator)
+            spectator.multicast = bool(multicast)
+        sessions.append(session)
+    queued = []
+    for _ in range(queued_count):
+        address, port, client_version, role = QUEUED.unpack_from(data, offset)
+        offset += QUEUED.size
+        check(role in (1, 2), f"queued player with role {role}")
+        queued.append(ServerClient((socket.inet_ntoa(address), port), role, client_version))
+    check(offset == len(data), f"{len(data) - offset} bytes after the last record")
+    return Checkpoint(next_match_id, sessions, queued)
+
+
+def sample_checkpoint(game_map: CompiledMap) -> bytes:
+    # A match between clients with watchers, one against a bot and a queued player
+    players = [ServerClient(("10.0.0.1", 4000), 1, 5), ServerClient(("10.0.0.2", 4000), 2, 1)]
+    human = Session(0, players[0], players[1], game_map.path)
+    human.add_spectator(ServerClient(("10.0.0.3", 4000), 0, 0))
+    human.add_spectator(ServerClient(("10.0.0.4", 4000), 0, 2))
+    bot = bot_client(BOTS[1](game_map), 2, 0)
+    against_bot = Session(1, ServerClient(("10.0.0.5", 4000), 1, 5), bot, game_map.path, immediate=True)
+    return encode(game_map, 2, [human, against_bot], [ServerClient(("10.0.0.6", 4000), 1, 3)])
+
+
+def check_decoding(map_path: str, corruptions: int) -> bool:
+    """
+    Decodes a sample checkpoint, every truncation of it and copies with random bytes changed. Each must
+    decode, be rejected as another format or raise CheckpointError, anything else is reported.
+    """
+    game_map = compile_map(map_path)
+    data = sample_checkpoint(game_map)
+    checkpoint = decode(data, map_path, game_map)
+    if checkpoint is None or len(checkpoint.sessions) != 2 or len(checkpoint.queued) != 1:
+        print("FAIL sample checkpoint did not decode")
+        return False
+    failures = 0
+    samples = [("truncated to", length, data[:length]) for length in range(len(data))]
+    generator = random.Random(0)
+    for k in range(corruptions):
+        corrupted = bytearray(data)
+        for _ in range(generator.randint(1, 4)):
+            corrupted[generator.randrange(len(corrupted))] = generator.randrange(256)
+        samples.append(("corrupted copy", k, bytes(corrupted)))
+    rejected = 0
+    for description, detail, sample in samples:
+        try:
+            rejected += decode(sample, map_path, game_map) is None
+        except CheckpointError:
+            rejected += 1
+        except Exception as e:
+            failures += 1
+            print(f"FAIL {description} {detail}: {type(e).__name__}: {e}")
+    print(f"{len(samples)} damaged checkpoints, {rejected} rejected, {failures} failures")
+    return failures == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that damaged checkpoints are rejected cleanly.")
+    parser.add_argument("--map", type=str, default="map.txt", help="Map to build the sample checkpoint on.")
+    parser.add_argument("--corruptions", type=int, default=10000,
+                        help="Copies with random bytes changed to decode (default: 10000).")
+    args = parser.parse_args()
+    raise SystemExit(0 if check_decoding(args.map, args.corruptions) else 1)
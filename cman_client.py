@@ -1,13 +1,17 @@
 #!/usr/bin/python3
 from typing import Optional
+from collections import deque
 from cman_utils import KeyInputHandler
 import socket
 import argparse
 import select
-from cman_game_map import Map
 import time
-import threading
-from constants import OPCODES, ROLE_TO_CODE, ERRORS, KEY_TO_DIRECTION
+from cman_game import Game, State
+from cman_game_map import Map
+from cman_codec import ProtocolError, server_decoder, JOIN, WATCH, ACK, INPUT, HEARTBEAT, PONG, \
+    KEYFRAME_REQUEST, QUIT, GAME_UPDATE, KEYFRAME, DELTA, MULTICAST, INPUT_ECHO, PING, END, ERROR
+from constants import OPCODES, ROLE_TO_CODE, ERRORS, KEY_TO_DIRECTION, PROTOCOL_VERSION, DELTA_FIELDS, \
+    HEARTBEAT_INTERVAL, MAX_DATAGRAM_SIZE
 
 
 
@@ -16,39 +20,85 @@ def get_args():
     parser.add_argument("role", type=str, help="The role of the player")
     parser.add_argument("addr", type=str, help="The address of the server")
     parser.add_argument("-p", "--port", type=int, default=1337, help="The port number (default: 1337)")
+    parser.add_argument("-m", "--match", type=int, default=None,
+                        help="Match id to watch (watchers only, default: newest match)")
     args = parser.parse_args()
-    return args.role, args.addr, args.port
+    return args.role, args.addr, args.port, args.match
 
 
 class Client:
     def __init__(self):
         self.map = Map()
         self.key_handler = KeyInputHandler()
-        self.role, addr, port = get_args()
+        self.role, addr, port, self.match_id = get_args()
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.multicast_socket: Optional[socket.socket] = None
         self.server_address = (addr, port)
         self.can_move = False
         self.last_key = None
+        self.last_sent = 0.0
+        self.join_message: Optional[bytes] = None # resent until the server answers
+        self.receive_buffer = bytearray(MAX_DATAGRAM_SIZE)
+        self.decoder = server_decoder(self.map.bitmap_length)
+        self.opcode_to_handler = {OPCODES["game update"]: self.handle_game_update,
+                                  OPCODES["keyframe"]: self.handle_keyframe,
+                                  OPCODES["delta"]: self.handle_delta,
+                                  OPCODES["multicast"]: self.join_multicast,
+                                  OPCODES["input echo"]: self.handle_input_echo,
+                                  OPCODES["ping"]: self.handle_ping,
+                                  OPCODES["end"]: self.game_end,
+                                  OPCODES["error"]: self.handle_error}
 
         self.last_update_message: Optional[bytearray] = None
+        self.last_seq: Optional[int] = None
+        self.awaiting_keyframe = True
+        self.rtt: Optional[tuple[int, int]] = None # round trip time and jitter in ms, as the server measured them
+
+        # Positions from the server. A player's own moves are also applied at once to a local
+        # game and replayed on top of every update until the server echoes their input sequence.
+        self.server_coords = [self.map.cman_coords, self.map.spirit_coords]
+        self.player = ROLE_TO_CODE[self.role] - 1
+        self.predictor = Game("map.txt") if self.player >= 0 else None
+        self.input_seq = 0
+        self.pending_inputs: deque[tuple[int, int]] = deque()
+
+    def send(self, message):
+        self.socket.sendto(message, self.server_address)
+        self.last_sent = time.monotonic()
+
+    def send_heartbeat(self):
+        # Only sent when nothing else went out lately, so the server knows we are still here.
+        # Until the server answered, the join goes out instead, since a busy server may drop it.
+        if time.monotonic() - self.last_sent >= HEARTBEAT_INTERVAL:
+            self.send(self.join_message or HEARTBEAT.pack(OPCODES["heartbeat"]))
 
     def join_game(self):
         print(f"Will try to join as {self.role}")
         if self.role == "watcher":
             print("You will not be able to move")
-        message = bytearray([OPCODES["join"], ROLE_TO_CODE[self.role]])
-        self.socket.sendto(message, self.server_address)
+        if self.role == "watcher" and self.match_id is not None:
+            message = WATCH.pack(OPCODES["watch"], PROTOCOL_VERSION, self.match_id)
+        else:
+            message = JOIN.pack(OPCODES["join"], (PROTOCOL_VERSION << 4) | ROLE_TO_CODE[self.role])
+        self.join_message = message
+        self.send(message)
         print("Sent join request, waiting for players")
         print("Map will load when game starts")
 
+    def send_ack(self, seq):
+        self.send(ACK.pack(OPCODES["ack"], seq))
+
     def handle_error(self, message):
-        error_message = ERRORS[message[1]]
+        _, code, seq = ERROR.unpack(message)
+        self.send_ack(seq)
+        error_message = ERRORS[code]
         print(error_message)
         self.socket.close()
         exit(1)
 
     def game_end(self, message):
-        _, winner, captures, score = message
+        _, winner, captures, score, seq = END.unpack(message)
+        self.send_ack(seq)
         winner = "Cman" if winner == 1 else "Spirit"
         print(f"GAME OVER\nThe winner is: {winner}")
         print(f"Cman got captured: {captures} times")
@@ -57,63 +107,144 @@ class Client:
         exit(0)
 
 
+    def predicted_coords(self):
+        if not self.pending_inputs:
+            return tuple(self.server_coords)
+        predictor = self.predictor
+        predictor.state = State.PLAY
+        predictor.cur_coords = list(self.server_coords)
+        for _, direction in self.pending_inputs:
+            predictor.apply_move(self.player, direction)
+        return tuple(predictor.cur_coords)
+
+    def render(self):
+        coords = self.predicted_coords()
+        if coords != (self.map.cman_coords, self.map.spirit_coords):
+            self.map.cman_coords, self.map.spirit_coords = coords
+            self.map.refresh_map()
+        status = [f"Number of times cman was caught: {self.map.attempts}"]
+        if self.rtt is not None:
+            status.append(f"Round trip time: {self.rtt[0]} ms, jitter {self.rtt[1]} ms")
+        if self.role == "watcher":
+            status.append("Spectator mode")
+        self.map.print_map(status)
+
     def handle_game_update(self, message):
         if message != self.last_update_message:
-            self.last_update_message = message
-            self.can_move = message[1] == 0
-            self.map.cman_coords = (message[2], message[3])
-            self.map.spirit_coords = (message[4], message[5])
-            self.map.attempts = message[6]
-            self.map.refresh_points(message)
-            self.map.print_map()
-            print(f"Number of times cman was caught: {self.map.attempts}")
-            if self.role == "watcher":
-                print("Spectator mode")
-
-
-    def handle_server_response(self):
-        opcode_to_handler = {0x80: self.handle_game_update,
-                             0x8F: self.game_end,
-                             0xFF: self.handle_error}
-        opcode_length = {0x80: 11,
-                             0x8F: 3,
-                             0xFF: 1}
-        readable, _, _ = select.select([self.socket], [], [], 0.01)
-        self.move()
-        if readable:
-            data, addr = self.socket.recvfrom(1024)
-            i = 0
-            while i < len(data):
-                opcode = data[i]
-                i += 1
-                command = data[i:i + opcode_length[opcode]]
-                i += opcode_length[opcode]
-                if opcode not in opcode_to_handler:
-                    return  # error
-                opcode_to_handler[opcode](bytearray([opcode]) + command)
-                self.move()
+            self.last_update_message = bytes(message) # message is a view of the receive buffer
+            _, flag, cman_row, cman_col, spirit_row, spirit_col, self.map.attempts = GAME_UPDATE.unpack_from(message)
+            self.can_move = flag == 0
+            self.server_coords = [(cman_row, cman_col), (spirit_row, spirit_col)]
+            self.map.set_points_bitmap(message[GAME_UPDATE.size:])
+            self.render()
+
+    def join_multicast(self, message):
+        _, group, group_port, seq = MULTICAST.unpack(message)
+        self.send_ack(seq)
+        if self.multicast_socket is not None:
+            return
+        group = socket.inet_ntoa(group)
+        multicast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        multicast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        multicast_socket.bind(("", group_port))
+        membership = socket.inet_aton(group) + socket.inet_aton("0.0.0.0")
+        multicast_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        self.multicast_socket = multicast_socket
+
+    def request_keyframe(self):
+        self.awaiting_keyframe = True
+        self.send(KEYFRAME_REQUEST.pack(OPCODES["keyframe request"]))
+
+    def handle_keyframe(self, message):
+        _, self.last_seq, flag, cman_row, cman_col, spirit_row, spirit_col, self.map.attempts = \
+            KEYFRAME.unpack_from(message)
+        self.awaiting_keyframe = False
+        self.can_move = flag == 0
+        self.server_coords = [(cman_row, cman_col), (spirit_row, spirit_col)]
+        self.map.set_points_bitmap(message[KEYFRAME.size:])
+        self.render()
+
+    def handle_delta(self, message):
+        _, seq, flag, mask = DELTA.unpack_from(message)
+        if self.awaiting_keyframe or seq == self.last_seq:
+            return
+        if seq != (self.last_seq + 1) & 0xFFFF: # missed an update, our state is stale
+            self.request_keyframe()
+            return
+        self.last_seq = seq
+        can_move = flag == 0
+        changed = can_move != self.can_move
+        self.can_move = can_move
+        i = DELTA.size
+        if mask & DELTA_FIELDS["cman"]:
+            self.server_coords[0] = (message[i], message[i + 1])
+            i += 2
+        if mask & DELTA_FIELDS["spirit"]:
+            self.server_coords[1] = (message[i], message[i + 1])
+            i += 2
+        if mask & DELTA_FIELDS["attempts"]:
+            self.map.attempts = message[i]
+            i += 1
+        if mask & DELTA_FIELDS["points"]:
+            count = message[i]
+            i += 1
+            self.map.eat_points([int.from_bytes(message[i + 2 * k:i + 2 * k + 2], "big") for k in range(count)])
+        if mask or changed:
+            self.render()
+
+    def handle_input_echo(self, message):
+        # Inputs up to the echoed one are part of the server state in the update that follows
+        _, seq = INPUT_ECHO.unpack(message)
+        while self.pending_inputs and (seq - self.pending_inputs[0][0]) & 0xFFFF < 0x8000:
+            self.pending_inputs.popleft()
+
+    def handle_ping(self, message):
+        _, timestamp, rtt, jitter = PING.unpack(message)
+        self.send(PONG.pack(OPCODES["pong"], timestamp))
+        rtt = (rtt, jitter) if rtt != 0xFFFF else None
+        if rtt != self.rtt:
+            self.rtt = rtt
+            if not self.awaiting_keyframe:
+                self.render()
+
+    def handle_server_response(self, sock):
+        size = sock.recv_into(self.receive_buffer)
+        self.join_message = None
+        try:
+            for opcode, message in self.decoder.messages(memoryview(self.receive_buffer)[:size]):
+                self.opcode_to_handler[opcode](message)
+        except ProtocolError:
+            return # the rest of the datagram cannot be split
+
+    def wait_for_events(self, timeout=None):
+        # Sleeps until a datagram or a key press arrives, then handles it right away
+        inputs = [self.socket, self.key_handler]
+        if self.multicast_socket is not None:
+            inputs.append(self.multicast_socket)
+        readable, _, _ = select.select(inputs, [], [], timeout)
+        for source in readable:
+            if source is self.key_handler:
+                self.handle_player_input()
+            else:
+                self.handle_server_response(source)
 
 
     def send_move(self, move):
-        message = bytearray([OPCODES["move"], move])
-        self.socket.sendto(message, self.server_address)
+        self.input_seq = (self.input_seq + 1) & 0xFFFF
+        self.send(INPUT.pack(OPCODES["input"], move, self.input_seq))
+        self.pending_inputs.append((self.input_seq, move))
+        self.render()
 
     def send_quit(self):
-        message = bytearray([OPCODES["quit"]])
-        self.socket.sendto(message, self.server_address)
+        self.send(QUIT.pack(OPCODES["quit"]))
         self.socket.close()
         exit(0)
 
     def handle_player_input(self):
-        while True:
-            pressed_keys = self.key_handler.get_pressed_keys()
-            for key in pressed_keys:
-                if key in KEY_TO_DIRECTION or key == 'Q' or key == 'q':
-                    self.last_key = key
-                    self.key_handler.clear_pressed_keys()
-                    time.sleep(0.05)
-                    continue
-
+        for key in self.key_handler.get_pressed_keys():
+            if key in KEY_TO_DIRECTION or key == 'Q' or key == 'q':
+                self.last_key = key
+                self.move()
 
 
     def move(self):
@@ -131,11 +262,9 @@ class Client:
 
     def run(self):
         self.join_game()
-        input_thread =  threading.Thread(target=self.handle_player_input, args=())
-        input_thread.daemon = True
-        input_thread.start()
         while True:
-            self.handle_server_response()
+            self.wait_for_events(HEARTBEAT_INTERVAL)
+            self.send_heartbeat()
 
 
 
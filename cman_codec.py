@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+import argparse
+import struct
+import time
+from typing import Callable, Iterator
+from constants import OPCODES, DELTA_FIELDS
+
+# Message layouts in network byte order, opcode byte included. Reliable server messages
+# end with the 2 byte sequence number the ReliableChannel appends.
+JOIN = struct.Struct("!BB")             # opcode, (version << 4) | role
+MOVE = struct.Struct("!BB")             # opcode, direction
+WATCH = struct.Struct("!BBH")           # opcode, version, match id
+ACK = struct.Struct("!BH")              # opcode, seq
+KEYFRAME_REQUEST = struct.Struct("!B")
+INPUT = struct.Struct("!BBH")           # opcode, direction, input seq
+HEARTBEAT = struct.Struct("!B")
+PONG = struct.Struct("!BI")             # opcode, timestamp of the ping answered
+QUIT = struct.Struct("!B")
+
+GAME_UPDATE = struct.Struct("!BB5B")    # opcode, flag, cman row/col, spirit row/col, attempts, then the points bitmap
+KEYFRAME = struct.Struct("!BHB5B")      # opcode, seq, flag, cman row/col, spirit row/col, attempts, then the points bitmap
+DELTA = struct.Struct("!BHBB")          # opcode, seq, flag, field mask, then the fields in DELTA_FIELDS order
+MULTICAST = struct.Struct("!B4sHH")     # opcode, group, port, seq
+INPUT_ECHO = struct.Struct("!BH")       # opcode, last applied input seq
+PING = struct.Struct("!BIHH")           # opcode, server timestamp in microseconds, round trip time and variation in ms
+END = struct.Struct("!BBBBH")           # opcode, winner, captures, score, seq
+ERROR = struct.Struct("!BBH")           # opcode, code, seq
+
+CLIENT_MESSAGES = {OPCODES["join"]: JOIN,
+                   OPCODES["move"]: MOVE,
+                   OPCODES["watch"]: WATCH,
+                   OPCODES["ack"]: ACK,
+                   OPCODES["keyframe request"]: KEYFRAME_REQUEST,
+                   OPCODES["input"]: INPUT,
+                   OPCODES["heartbeat"]: HEARTBEAT,
+                   OPCODES["pong"]: PONG,
+                   OPCODES["quit"]: QUIT}
+
+SERVER_MESSAGES = {OPCODES["game update"]: GAME_UPDATE,
+                   OPCODES["keyframe"]: KEYFRAME,
+                   OPCODES["delta"]: DELTA,
+                   OPCODES["multicast"]: MULTICAST,
+                   OPCODES["input echo"]: INPUT_ECHO,
+                   OPCODES["ping"]: PING,
+                   OPCODES["end"]: END,
+                   OPCODES["error"]: ERROR}
+
+DIRECTIONS = range(4)
+
+
+class ProtocolError(ValueError):
+    """
+    A malformed datagram. kind is a short label for metrics: unknown_opcode, truncated or bad_value.
+    """
+    def __init__(self, kind: str, message: str) -> None:
+        super().__init__(message)
+        self.kind = kind
+
+
+def delta_length(data: memoryview, i: int) -> int:
+    """
+    Length of the delta message starting at data[i], read from its field mask.
+    """
+    if i + DELTA.size > len(data):
+        raise ProtocolError("truncated", "delta header cut short")
+    mask = data[i + DELTA.size - 1]
+    length = DELTA.size
+    length += 2 if mask & DELTA_FIELDS["cman"] else 0
+    length += 2 if mask & DELTA_FIELDS["spirit"] else 0
+    length += 1 if mask & DELTA_FIELDS["attempts"] else 0
+    if mask & DELTA_FIELDS["points"]:
+        if i + length >= len(data):
+            raise ProtocolError("truncated", "delta point count cut short")
+        length += 1 + 2 * data[i + length]
+    return length
+
+
+class Decoder:
+    """
+    Splits a datagram into its messages without copying: each message is yielded as a
+    memoryview slice of the datagram, opcode included, so it is only valid until the
+    buffer it came from is reused.
+    """
+    def __init__(self, lengths: dict[int, int], variable: dict[int, Callable[[memoryview, int], int]]) -> None:
+        self.lengths = lengths
+        self.variable = variable
+
+    def messages(self, data: memoryview) -> Iterator[tuple[int, memoryview]]:
+        lengths = self.lengths
+        end = len(data)
+        i = 0
+        while i < end:
+            opcode = data[i]
+            length = lengths.get(opcode)
+            if length is None:
+                measure = self.variable.get(opcode)
+                if measure is None:
+                    raise ProtocolError("unknown_opcode", f"unknown opcode 0x{opcode:02X}")
+                length = measure(data, i)
+            if i + length > end:
+                raise ProtocolError("truncated", f"0x{opcode:02X} needs {length} bytes, {end - i} left")
+            yield opcode, data[i:i + length]
+            i += length
+
+
+def client_decoder() -> Decoder:
+    """
+    Decoder for messages sent by clients, used by the server.
+    """
+    return Decoder({opcode: layout.size for opcode, layout in CLIENT_MESSAGES.items()}, {})
+
+
+def server_decoder(bitmap_length: int) -> Decoder:
+    """
+    Decoder for messages sent by the server, whose full updates carry a points bitmap of bitmap_length bytes.
+    """
+    lengths = {opcode: layout.size for opcode, layout in SERVER_MESSAGES.items() if opcode != OPCODES["delta"]}
+    lengths[OPCODES["game update"]] += bitmap_length
+    lengths[OPCODES["keyframe"]] += bitmap_length
+    return Decoder(lengths, {OPCODES["delta"]: delta_length})
+
+
+def check_direction(direction: int) -> int:
+    if direction not in DIRECTIONS:
+        raise ProtocolError("bad_value", f"direction {direction} out of range")
+    return direction
+
+
+def benchmark(iterations: int) -> None:
+    """
+    Prints messages per second for splitting datagrams the old way (slice and rebuild
+    each message) next to the codec, and for packing messages by hand and with struct.
+    """
+    bitmap_length = 5
+    client_datagram = memoryview(JOIN.pack(0x00, 0x41) + INPUT.pack(0x05, 2, 7) + HEARTBEAT.pack(0x06)
+                                 + ACK.pack(0x03, 9) + MOVE.pack(0x01, 3))
+    server_datagram = memoryview(INPUT_ECHO.pack(0x84, 7) + KEYFRAME.pack(0x81, 1, 0, 1, 2, 3, 4, 3)
+                                 + bytes(bitmap_length) + DELTA.pack(0x82, 2, 0, 0x0B) + bytes([1, 2, 3, 4, 1, 0, 5]))
+    old_lengths = {0x00: 1, 0x01: 1, 0x03: 2, 0x05: 3, 0x06: 0}
+
+    def old_split(data):
+        i = 0
+        while i < len(data):
+            opcode = data[i]
+            i += 1
+            length = old_lengths[opcode]
+            command = data[i:i + length]
+            i += length
+            yield opcode, bytearray([opcode]) + command
+
+    decoder = client_decoder()
+    results = []
+    for name, split, datagram, count in (
+            ("slice + rebuild", old_split, client_datagram, 5),
+            ("codec, client messages", decoder.messages, client_datagram, 5),
+            ("codec, server messages", server_decoder(bitmap_length).messages, server_datagram, 3)):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for _ in split(datagram):
+                pass
+        results.append((f"parse {name}", iterations * count / (time.perf_counter() - start)))
+
+    bitmap = bytes(bitmap_length)
+    start = time.perf_counter()
+    for seq in range(iterations):
+        message = bytearray([OPCODES["keyframe"]])
+        message += (seq & 0xFFFF).to_bytes(2, "big")
+        message.append(1)
+        for value in (1, 2, 3, 4, 3):
+            message.append(value)
+        message += bitmap
+    results.append(("encode keyframe, appended", iterations / (time.perf_counter() - start)))
+    buffer = bytearray(KEYFRAME.size + bitmap_length)
+    pack_into = KEYFRAME.pack_into
+    start = time.perf_counter()
+    for seq in range(iterations):
+        pack_into(buffer, 0, OPCODES["keyframe"], seq & 0xFFFF, 1, 1, 2, 3, 4, 3)
+        buffer[KEYFRAME.size:] = bitmap
+    results.append(("encode keyframe, packed into a reused buffer", iterations / (time.perf_counter() - start)))
+    start = time.perf_counter()
+    for seq in range(iterations):
+        message = bytearray([OPCODES["input"], 2]) + (seq & 0xFFFF).to_bytes(2, "big")
+    results.append(("encode input, bytearray + to_bytes", iterations / (time.perf_counter() - start)))
+    pack = INPUT.pack
+    start = time.perf_counter()
+    for seq in range(iterations):
+        message = pack(OPCODES["input"], 2, seq & 0xFFFF)
+    results.append(("encode input, struct pack", iterations / (time.perf_counter() - start)))
+    for name, rate in results:
+        print(f"{name}: {rate:,.0f} messages/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark protocol parsing and encoding.")
+    parser.add_argument("--iterations", type=int, default=200000, help="Datagrams to parse and messages to encode (default: 200000).")
+    args = parser.parse_args()
+    benchmark(args.iterations)
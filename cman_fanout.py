@@ -0,0 +1,149 @@
+import ctypes
+import ctypes.util
+import socket
+import struct
+import time
+from typing import Optional
+from cman_metrics import Metrics
+
+
+class IoVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(IoVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def load_sendmmsg():
+    """
+    Returns libc's sendmmsg, which sends a batch of datagrams in one syscall,
+    or None where it is not available and plain sendto loops are used instead.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+def sockaddr_in(address: tuple[str, int]) -> ctypes.Array:
+    packed = struct.pack("=H", socket.AF_INET) + struct.pack("!H", address[1]) + socket.inet_aton(address[0])
+    return ctypes.create_string_buffer(packed + bytes(8), 16)
+
+
+class Destinations:
+    """
+    A fixed list of addresses that receive the same frame. With sendmmsg the message
+    headers are built once and point at a shared iovec, so a send only swaps the payload.
+    """
+    def __init__(self, addresses: list[tuple[str, int]], batched: bool) -> None:
+        self.addresses = addresses
+        self.iov = IoVec()
+        self.names = []
+        self.headers: Optional[ctypes.Array] = None
+        if batched and addresses:
+            self.names = [sockaddr_in(address) for address in addresses]
+            self.headers = (MMsgHdr * len(addresses))()
+            for header, name in zip(self.headers, self.names):
+                header.msg_hdr.msg_name = ctypes.addressof(name)
+                header.msg_hdr.msg_namelen = 16
+                header.msg_hdr.msg_iov = ctypes.pointer(self.iov)
+                header.msg_hdr.msg_iovlen = 1
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+
+class Fanout:
+    """
+    Sends one prebuilt frame to many addresses and keeps per-tick timing of the fan-out.
+    """
+    def __init__(self, udp_socket: socket.socket, metrics: Optional[Metrics] = None) -> None:
+        self.udp_socket = udp_socket
+        self.metrics = metrics
+        self.sendmmsg = load_sendmmsg()
+        self.tick_time = 0.0
+        self.tick_datagrams = 0
+        self.ticks = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.datagrams = 0
+        self.dropped = 0
+
+    def destinations(self, addresses: list[tuple[str, int]]) -> Destinations:
+        return Destinations(addresses, self.sendmmsg is not None)
+
+    def send(self, message: bytes, destinations: Destinations) -> None:
+        if not destinations:
+            return
+        start = time.perf_counter()
+        if destinations.headers is not None:
+            sent = self.send_batched(message, destinations)
+        else:
+            sent = 0
+            sendto = self.udp_socket.sendto
+            for address in destinations.addresses:
+                try:
+                    sendto(message, address)
+                    sent += 1
+                except (BlockingIOError, InterruptedError):
+                    pass
+        self.tick_time += time.perf_counter() - start
+        self.tick_datagrams += sent
+        self.dropped += len(destinations) - sent
+        if self.metrics is not None:
+            self.metrics.count_out(message[0], len(message), sent)
+
+    def send_batched(self, message: bytes, destinations: Destinations) -> int:
+        payload = ctypes.create_string_buffer(bytes(message), len(message))
+        destinations.iov.iov_base = ctypes.addressof(payload)
+        destinations.iov.iov_len = len(message)
+        fd = self.udp_socket.fileno()
+        total = len(destinations)
+        sent = 0
+        while sent < total:
+            batch = (MMsgHdr * (total - sent)).from_buffer(destinations.headers, sent * ctypes.sizeof(MMsgHdr))
+            result = self.sendmmsg(fd, batch, total - sent, 0)
+            if result <= 0: # EAGAIN with a full send buffer, the rest is lost like any UDP datagram
+                break
+            sent += result
+        return sent
+
+    def end_tick(self) -> None:
+        # Sends made between ticks (immediate input mode) are counted with the next tick
+        self.ticks += 1
+        self.total_time += self.tick_time
+        self.datagrams += self.tick_datagrams
+        if self.tick_time > self.max_time:
+            self.max_time = self.tick_time
+        self.tick_time = 0.0
+        self.tick_datagrams = 0
+
+    def report(self) -> str:
+        average = self.total_time / self.ticks if self.ticks else 0.0
+        line = (f"Fan-out: {self.datagrams} datagrams over {self.ticks} ticks, "
+                f"{'sendmmsg' if self.sendmmsg is not None else 'sendto'}, "
+                f"avg {average * 1000:.3f} ms max {self.max_time * 1000:.3f} ms per tick, "
+                f"{self.dropped} dropped")
+        self.ticks = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.datagrams = 0
+        self.dropped = 0
+        return line
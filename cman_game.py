@@ -1,6 +1,5 @@
-from cman_game_map import read_map
+from cman_game_map import compile_map
 import os
-from map_constants import PLAYER_CHARS, POINT_CHAR, PASS_CHARS
 from enum import IntEnum
 
 MAX_ATTEMPTS = 3
@@ -34,19 +33,21 @@ class Game():
 
 		map_path (str): a path to the textual map file
 
+		The map is compiled once per file and shared between games, see cman_game_map.compile_map.
+
 		"""
 		assert os.path.isfile(map_path), "map file does not exist."
-		self.board = read_map(map_path).split('\n')
-		self.board_dims = (len(self.board), len(self.board[0]))
+		self.map = compile_map(map_path)
+		self.board = self.map.lines
+		self.board_dims = (self.map.rows, self.map.cols)
+		self.moves = self.map.moves
 
-		self.start_coords = []
-		for p_char in PLAYER_CHARS:
-			start_row = [p_char in row for row in self.board].index(True)
-			self.start_coords.append((start_row, self.board[start_row].index(p_char)))
+		self.start_coords = list(self.map.start_coords)
 
-		self.points = {(i,j):1 for i in range(self.board_dims[0])
-							   for j in range(self.board_dims[1])
-							   if self.board[i][j] == POINT_CHAR}
+		self.points = dict.fromkeys(self.map.point_positions, 1)
+		self.point_index = self.map.point_index
+		self.points_bytes_length = (len(self.points) + 7) // 8
+		self.win_score = min(WIN_SCORE, len(self.points))
 		self.restart_game()
 
 
@@ -60,6 +61,9 @@ class Game():
 		self.score = 0
 		for p in self.points.keys():
 			self.points[p] = 1
+		self.eaten_bits = 0
+		self.eaten_points = []
+		self.points_bytes = None
 		self.lives = MAX_ATTEMPTS
 		self.state = State.WAIT
 		self.winner = None
@@ -105,6 +109,53 @@ class Game():
 		"""
 		return self.points
 
+	def get_points_bytes(self):
+		"""
+		
+		Returns:
+
+		bytes: The collected points as a bitmap, one bit per point in point index order starting from the most significant bit of the first byte
+
+		A set bit means the point was collected. The bytes are cached until the next point is collected.
+
+		"""
+		if self.points_bytes is None:
+			self.points_bytes = self.eaten_bits.to_bytes(self.points_bytes_length, 'big')
+		return self.points_bytes
+
+	def get_eaten_points(self):
+		"""
+		
+		Returns:
+
+		list(int): The indices of the collected points, in the order they were collected
+
+		"""
+		return self.eaten_points
+
+	def set_points_bytes(self, points_bytes):
+		"""
+		
+		Marks points as collected from a bitmap in the format returned by get_points_bytes, such as one saved in a checkpoint.
+
+		The collection order is not in the bitmap, get_eaten_points lists the collected points in index order afterwards.
+
+		Parameters:
+
+		points_bytes (bytes): The collected points bitmap
+
+		"""
+		self.eaten_bits = int.from_bytes(points_bytes, 'big')
+		self.points_bytes = None
+		self.eaten_points = []
+		top_bit = self.points_bytes_length * 8 - 1
+		for coords, index in self.point_index.items():
+			eaten = (self.eaten_bits >> (top_bit - index)) & 1
+			self.points[coords] = 1 - eaten
+			if eaten:
+				self.eaten_points.append(index)
+		self.eaten_points.sort()
+
 	def get_winner(self):
 		"""
 		
@@ -174,22 +225,22 @@ class Game():
 		if direction == Direction.NONE:
 			return False
 
-		p_coords = self.cur_coords[player]
-		dr = -1 if direction == Direction.UP else 1 if direction == Direction.DOWN else 0
-		dc = -1 if direction == Direction.LEFT else 1 if direction == Direction.RIGHT else 0
-		next_coords = (p_coords[0] + dr, p_coords[1] + dc)
+		next_coords = self.moves[self.cur_coords[player]][direction]
 
-		if any(x < 0 for x in next_coords) or next_coords[0] >= self.board_dims[0] or next_coords[1] >= self.board_dims[1]:
-			return False
-		if self.board[next_coords[0]][next_coords[1]] not in PASS_CHARS:
+		if next_coords is None:
 			return False
 		else:
 			self.state = State.PLAY
 			self.cur_coords[player] = next_coords
 			if player == Player.CMAN and next_coords in self.points.keys():
+				if self.points[next_coords]:
+					index = self.point_index[next_coords]
+					self.eaten_bits |= 1 << (self.points_bytes_length * 8 - 1 - index)
+					self.eaten_points.append(index)
+					self.points_bytes = None
 				self.score += self.points[next_coords]
 				self.points[next_coords] = 0
-				if self.score >= WIN_SCORE:
+				if self.score >= self.win_score:
 					self.declare_winner(Player.CMAN)
 			if (player == Player.CMAN and next_coords in self.cur_coords[1:]) or (player != Player.CMAN and next_coords == self.cur_coords[0]):
 				self.lives -= 1
@@ -1,5 +1,7 @@
 from map_constants import *
-from copy import deepcopy
+from cman_render import TerminalRenderer
+from types import MappingProxyType
+import hashlib
 import os
 import platform
 
@@ -22,7 +24,7 @@ def read_map(path):
         assert map_chars.issubset({CMAN_CHAR, SPIRIT_CHAR, POINT_CHAR, WALL_CHAR, FREE_CHAR, '\n'}), "invalid char in map."
         assert map_data.count(CMAN_CHAR) == 1, "Map needs to have a single C-Man starting point."
         assert map_data.count(SPIRIT_CHAR) == 1, "Map needs to have a single Spirit starting point."
-        assert map_data.count(POINT_CHAR) == MAX_POINTS, f"Map needs to have {MAX_POINTS} score points."
+        assert 0 < map_data.count(POINT_CHAR) <= MAX_POINTS, f"Map needs to have between 1 and {MAX_POINTS} score points."
 
         map_lines = map_data.split('\n')
         assert all(len(line) == len(map_lines[0]) for line in map_lines), "map is not square."
@@ -36,6 +38,80 @@ def read_map(path):
 
         return map_data
 
+class CompiledMap:
+    """
+
+    Immutable, fully parsed map, shared by every Game and Map built from the same file.
+
+    Holds a SHA-256 digest of the map text identifying it, the board rows, a flat walkability grid, the cells reachable by each move
+    from every walkable cell (indexed by direction, None where a wall blocks),
+    the point positions with their stable indices, and the starting coordinates.
+
+    """
+    __slots__ = ("path", "digest", "lines", "rows", "cols", "walkable", "moves", "point_positions",
+                 "point_index", "start_coords")
+
+    def __init__(self, path, map_data):
+        object.__setattr__(self, "path", path)
+        object.__setattr__(self, "digest", hashlib.sha256(map_data.encode()).digest())
+        lines = tuple(map_data.split('\n'))
+        rows, cols = len(lines), len(lines[0])
+        object.__setattr__(self, "lines", lines)
+        object.__setattr__(self, "rows", rows)
+        object.__setattr__(self, "cols", cols)
+        walkable = bytes(lines[i][j] in PASS_CHARS for i in range(rows) for j in range(cols))
+        object.__setattr__(self, "walkable", walkable)
+        moves = {}
+        for i in range(rows):
+            for j in range(cols):
+                if not walkable[i * cols + j]:
+                    continue
+                targets = []
+                for dr, dc in ((-1, 0), (0, -1), (1, 0), (0, 1)): # up, left, down, right
+                    r, c = i + dr, j + dc
+                    inside = 0 <= r < rows and 0 <= c < cols
+                    targets.append((r, c) if inside and walkable[r * cols + c] else None)
+                moves[(i, j)] = tuple(targets)
+        object.__setattr__(self, "moves", MappingProxyType(moves))
+        point_positions = tuple((i, j) for i in range(rows) for j in range(cols) if lines[i][j] == POINT_CHAR)
+        object.__setattr__(self, "point_positions", point_positions)
+        object.__setattr__(self, "point_index", MappingProxyType({coords: k for k, coords in enumerate(point_positions)}))
+        start_coords = []
+        for p_char in PLAYER_CHARS:
+            start_row = [p_char in row for row in lines].index(True)
+            start_coords.append((start_row, lines[start_row].index(p_char)))
+        object.__setattr__(self, "start_coords", tuple(start_coords))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CompiledMap is immutable")
+
+    def is_walkable(self, coords):
+        return bool(self.walkable[coords[0] * self.cols + coords[1]])
+
+
+_compiled_maps = {}
+
+def compile_map(path):
+    """
+
+    Returns the CompiledMap of a map file, parsing and validating it only the first
+    time it is requested or after the file changed on disk.
+
+    Parameters:
+
+    path (str): path to the textual map file
+
+    """
+    key = os.path.abspath(path)
+    stat = os.stat(key)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _compiled_maps.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    compiled = CompiledMap(key, read_map(key))
+    _compiled_maps[key] = (version, compiled)
+    return compiled
+
 def clear_terminal():
     if platform.system() == "Windows":
         os.system("cls")
@@ -59,7 +135,7 @@ def load_map(map_path):
     return board
 
 def get_full_map(board, points, cman_coords, spirit_coords):
-    board = deepcopy(board)
+    board = [row[:] for row in board]
     i, j = cman_coords
     board[i][j] = CHAR_VISUAL[CMAN_CHAR]
 
@@ -71,7 +147,7 @@ def get_full_map(board, points, cman_coords, spirit_coords):
     return board
 
 def strip_map(board):
-    board = deepcopy(board)
+    board = [row[:] for row in board]
     rows, columns = (len(board), len(board[0]))
     for i in range(rows):
         for j in range(columns):
@@ -80,36 +156,41 @@ def strip_map(board):
 
 
 class Map:
-    def __init__(self):
-        og_map = load_map("map.txt")
+    def __init__(self, map_path="map.txt"):
+        compiled = compile_map(map_path)
+        og_map = [list(row) for row in compiled.lines]
         self.attempts = 0
-        self.rows = len(og_map)
-        self.cols = len(og_map[0])
-        self.points_alive = [True]*MAX_POINTS
-        self.og_point_positions = [(i, j) for i in range(self.rows)
-                                            for j in range(self.cols)
-                                        if og_map[i][j] == POINT_CHAR]
-        self.point_positions = deepcopy(self.og_point_positions)
-        self.cman_coords = [(i, j) for i in range(self.rows) for j in range(self.cols) if og_map[i][j] == CMAN_CHAR]
-        self.cman_coords = self.cman_coords[0]
-        self.spirit_coords = [(i, j) for i in range(self.rows) for j in range(self.cols) if og_map[i][j] == SPIRIT_CHAR]
-        self.spirit_coords = self.spirit_coords[0]
+        self.rows = compiled.rows
+        self.cols = compiled.cols
+        self.og_point_positions = compiled.point_positions
+        self.points_alive = [True]*len(self.og_point_positions)
+        self.bitmap_length = (len(self.og_point_positions) + 7) // 8
+        self.point_positions = list(self.og_point_positions)
+        self.cman_coords, self.spirit_coords = compiled.start_coords
         self.base_map = strip_map(og_map)
         self.full_map = get_full_map(self.base_map, self.point_positions, self.cman_coords, self.spirit_coords)
+        self.renderer = TerminalRenderer()
 
 
-    def print_map(self):
-        print_map(self.full_map)
+    def print_map(self, status=None):
+        self.renderer.draw(self.full_map, status)
 
     def refresh_map(self):
         self.full_map = get_full_map(self.base_map, self.point_positions, self.cman_coords, self.spirit_coords)
 
     def refresh_points(self, message: bytearray):
-        byte_array = message[7:12]
-        for i in range(40):
-            byte_index = i // 8
-            bit_index = 7 - i % 8
-            bit = (byte_array[byte_index] >> bit_index) & 1
-            self.points_alive[i] = (bit == 0)
-        self.point_positions = [self.og_point_positions[i] for i in range(MAX_POINTS) if self.points_alive[i]]
+        self.set_points_bitmap(message[7:7 + self.bitmap_length])
+
+    def eat_points(self, indices: list[int]):
+        for i in indices:
+            self.points_alive[i] = False
+        self.point_positions = [self.og_point_positions[i] for i in range(len(self.points_alive)) if self.points_alive[i]]
+        self.refresh_map()
+
+    def set_points_bitmap(self, byte_array: bytearray):
+        bits = int.from_bytes(byte_array[:self.bitmap_length], "big")
+        top_bit = self.bitmap_length * 8 - 1
+        for i in range(len(self.points_alive)):
+            self.points_alive[i] = not (bits >> (top_bit - i)) & 1
+        self.point_positions = [self.og_point_positions[i] for i in range(len(self.points_alive)) if self.points_alive[i]]
         self.refresh_map()
@@ -0,0 +1,110 @@
+import logging
+import os
+import socket
+import time
+from typing import Callable, Optional
+from cman_ratelimit import TokenBucket
+from constants import INGEST_BUDGET, MAX_DATAGRAM_SIZE, ERROR_LOG_RATE, BURST_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def read_kernel_drops(udp_socket: socket.socket) -> Optional[int]:
+    """
+    Returns the number of datagrams the kernel dropped on udp_socket because its
+    receive buffer was full, or None where /proc/net/udp is not available.
+    """
+    try:
+        inode = str(os.fstat(udp_socket.fileno()).st_ino)
+        with open("/proc/net/udp", "r") as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                if fields[9] == inode:
+                    return int(fields[-1])
+    except (OSError, IndexError, ValueError, StopIteration):
+        pass
+    return None
+
+
+class Ingest:
+    """
+    Drains every pending datagram from a non-blocking UDP socket, up to a bounded
+    budget per call, into a single preallocated buffer. The handler gets a memoryview
+    over that buffer which is only valid until it returns. A handler that raises is
+    counted and logged, at most ERROR_LOG_RATE times per second, and draining goes on.
+    """
+    def __init__(self, udp_socket: socket.socket,
+                 handler: Callable[[memoryview, tuple[str, int], float], None],
+                 budget: int = INGEST_BUDGET) -> None:
+        self.udp_socket = udp_socket
+        self.handler = handler
+        self.budget = budget
+        self.buffer = bytearray(MAX_DATAGRAM_SIZE)
+        self.view = memoryview(self.buffer)
+        self.datagrams = 0
+        self.budget_exhausted = 0
+        self.handler_errors = 0
+        self.error_log = TokenBucket(ERROR_LOG_RATE, ERROR_LOG_RATE * BURST_SECONDS, time.monotonic())
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_samples = 0
+        self.report_datagrams = 0
+        self.report_drops = read_kernel_drops(udp_socket)
+        self.report_time = time.monotonic()
+
+    def drain(self) -> int:
+        recvfrom_into = self.udp_socket.recvfrom_into
+        view = self.view
+        received = 0
+        reads = 0 # failed reads count against the budget too, so a failing socket cannot stall the loop
+        while reads < self.budget:
+            reads += 1
+            try:
+                size, address = recvfrom_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                continue # ICMP errors from departed clients surface here on some platforms
+            received += 1
+            try:
+                self.handler(view[:size], address, time.monotonic())
+            except Exception:
+                self.handler_errors += 1
+                if self.error_log.take(time.monotonic()):
+                    logger.exception("Handling a datagram from %s:%d failed", address[0], address[1])
+        else:
+            self.budget_exhausted += 1
+        self.datagrams += received
+        return received
+
+    def record_latency(self, received_at: float) -> None:
+        latency = time.monotonic() - received_at
+        self.latency_total += latency
+        self.latency_samples += 1
+        if latency > self.latency_max:
+            self.latency_max = latency
+
+    def report(self) -> str:
+        now = time.monotonic()
+        elapsed = max(now - self.report_time, 1e-9)
+        received = self.datagrams - self.report_datagrams
+        drops = read_kernel_drops(self.udp_socket)
+        if drops is None or self.report_drops is None:
+            drop_text = "n/a"
+        else:
+            new_drops = drops - self.report_drops
+            drop_text = f"{new_drops} ({100 * new_drops / max(received + new_drops, 1):.2f}%)"
+        average = self.latency_total / self.latency_samples if self.latency_samples else 0.0
+        line = (f"Ingest: {received / elapsed:.1f} datagrams/s, kernel drops {drop_text}, "
+                f"budget exhausted {self.budget_exhausted} times, {self.handler_errors} handler errors, "
+                f"input-to-state latency avg {average * 1000:.1f} ms max {self.latency_max * 1000:.1f} ms")
+        self.report_time = now
+        self.report_datagrams = self.datagrams
+        self.report_drops = drops
+        self.budget_exhausted = 0
+        self.handler_errors = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_samples = 0
+        return line
@@ -0,0 +1,53 @@
+from typing import Callable, Hashable, Optional
+
+
+class TimerWheel:
+    """
+    A hashed timer wheel for idle timeouts. Keys sit in the slot of their deadline and
+    are only looked at when the wheel passes that slot, so activity from a client costs
+    nothing here beyond the caller updating the timestamp deadline_of reads. A key found
+    still active when its slot comes up is moved to the slot of its new deadline, and
+    deadlines more than a turn away wait for the turn that reaches them.
+    """
+    def __init__(self, slots: int, resolution: float, now: float,
+                 deadline_of: Callable[[Hashable], Optional[float]]) -> None:
+        self.resolution = resolution
+        self.slots: list[set[Hashable]] = [set() for _ in range(slots)]
+        self.position = int(now / resolution)
+        self.deadline_of = deadline_of # None once the key is gone, it is then dropped quietly
+
+    def __len__(self) -> int:
+        return sum(len(slot) for slot in self.slots)
+
+    def slot_for(self, deadline: float) -> set[Hashable]:
+        index = max(int(deadline / self.resolution), self.position + 1)
+        return self.slots[index % len(self.slots)]
+
+    def add(self, key: Hashable) -> None:
+        deadline = self.deadline_of(key)
+        if deadline is not None:
+            self.slot_for(deadline).add(key)
+
+    def advance(self, now: float) -> list[Hashable]:
+        """
+        Moves the wheel up to now and returns the keys whose deadline has passed.
+        """
+        target = int(now / self.resolution)
+        steps = min(target - self.position, len(self.slots))
+        expired = []
+        for _ in range(steps):
+            self.position += 1
+            slot = self.slots[self.position % len(self.slots)]
+            for key in list(slot):
+                deadline = self.deadline_of(key)
+                if deadline is not None and deadline > now:
+                    new_slot = self.slot_for(deadline)
+                    if new_slot is not slot:
+                        slot.discard(key)
+                        new_slot.add(key)
+                    continue
+                slot.discard(key)
+                if deadline is not None:
+                    expired.append(key)
+        self.position = max(self.position, target)
+        return expired
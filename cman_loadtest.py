@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from typing import Optional
+from cman_game_map import compile_map
+from cman_codec import (ProtocolError, server_decoder, WATCH, JOIN, ACK, MOVE, QUIT, KEYFRAME_REQUEST, GAME_UPDATE,
+                        KEYFRAME, DELTA)
+from constants import OPCODES, ROLE_TO_CODE, DELTA_FIELDS, SOURCE_RATE, NEW_SOURCE_RATE, BURST_SECONDS
+
+DIRECTION_STEPS = {0: (-1, 0), 1: (0, -1), 2: (1, 0), 3: (0, 1)}
+JOIN_RETRY_INTERVAL = 1
+LEGACY_OPCODES = {OPCODES["game update"], OPCODES["end"], OPCODES["error"]} # all the baseline client can parse
+
+
+def percentiles(samples: list[float]) -> dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {"count": len(ordered), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": ordered[-1]}
+
+
+def read_tick_log(path: str) -> list[float]:
+    with open(path) as f:
+        return [float(line) for line in f if line.endswith("\n")] # the last line may still be written
+
+
+class Bot(asyncio.DatagramProtocol):
+    """
+    A headless client speaking the cman_client protocol, version 1 with keyframes and deltas,
+    or version 0 with full frames only, which counts every message the baseline client could
+    not parse. Players move randomly or follow a script of directions, watchers only listen.
+    """
+    def __init__(self, harness: "LoadTest", role: str, match_id: Optional[int] = None) -> None:
+        self.harness = harness
+        self.role = role
+        self.match_id = match_id
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.last_seq: Optional[int] = None
+        self.awaiting_keyframe = True
+        self.coords: list[tuple[int, int]] = [(0, 0), (0, 0)]
+        self.can_move = False
+        self.last_update = 0.0
+        self.updates = 0
+        self.pending_move: Optional[tuple[float, tuple[int, int]]] = None
+        self.script_position = 0
+        self.finished = False
+        self.answered = False
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+        version = self.harness.version
+        if self.match_id is not None and version >= 1: # version 0 watchers join the newest match
+            message = WATCH.pack(OPCODES["watch"], version, self.match_id)
+        else:
+            message = JOIN.pack(OPCODES["join"], (version << 4) | ROLE_TO_CODE[self.role])
+        self.send_join(message)
+
+    def send_join(self, message: bytes) -> None:
+        # Resent until the server answers, in case its rate limit dropped the join
+        if self.answered or self.transport.is_closing():
+            return
+        self.send(message)
+        asyncio.get_running_loop().call_later(JOIN_RETRY_INTERVAL, self.send_join, message)
+
+    def send(self, message: bytes) -> None:
+        self.harness.datagrams_out += 1
+        self.transport.sendto(message)
+
+    def datagram_received(self, data: bytes, address: tuple[str, int]) -> None:
+        self.harness.datagrams_in += 1
+        self.answered = True
+        now = time.monotonic()
+        try:
+            for opcode, message in self.harness.decoder.messages(memoryview(data)):
+                self.handle_message(opcode, message, now)
+        except ProtocolError:
+            self.harness.unknown_messages += 1
+
+    def handle_message(self, opcode: int, message: memoryview, now: float) -> None:
+        if self.harness.version == 0 and opcode not in LEGACY_OPCODES:
+            self.harness.legacy_violations += 1
+        if opcode == OPCODES["game update"]:
+            self.handle_game_update(message, now)
+        elif opcode in (OPCODES["keyframe"], OPCODES["delta"]):
+            self.handle_update(message, now)
+        elif opcode in (OPCODES["end"], OPCODES["error"], OPCODES["multicast"]):
+            self.send(ACK.pack(OPCODES["ack"], int.from_bytes(message[-2:], "big")))
+            if opcode != OPCODES["multicast"] and not self.finished:
+                self.finished = True
+                self.harness.games_finished += opcode == OPCODES["end"]
+                self.harness.errors += opcode == OPCODES["error"]
+
+    def handle_update(self, message: memoryview, now: float) -> None:
+        if message[0] == OPCODES["keyframe"]:
+            _, seq, flag, cman_row, cman_col, spirit_row, spirit_col, _ = KEYFRAME.unpack_from(message)
+            if self.last_seq is not None and not self.awaiting_keyframe:
+                self.harness.lost_updates += max(0, ((seq - self.last_seq) & 0xFFFF) - 1)
+            self.awaiting_keyframe = False
+            self.coords = [(cman_row, cman_col), (spirit_row, spirit_col)]
+        else:
+            _, seq, flag, mask = DELTA.unpack_from(message)
+            if self.awaiting_keyframe or seq == self.last_seq:
+                return
+            missed = ((seq - self.last_seq) & 0xFFFF) - 1
+            if missed:
+                self.harness.lost_updates += missed
+                self.awaiting_keyframe = True
+                self.send(KEYFRAME_REQUEST.pack(OPCODES["keyframe request"]))
+                return
+            i = DELTA.size
+            for player, bit in ((0, DELTA_FIELDS["cman"]), (1, DELTA_FIELDS["spirit"])):
+                if mask & bit:
+                    self.coords[player] = (message[i], message[i + 1])
+                    i += 2
+        self.last_seq = seq
+        self.update_received(flag, now)
+
+    def handle_game_update(self, message: memoryview, now: float) -> None:
+        _, flag, cman_row, cman_col, spirit_row, spirit_col, _ = GAME_UPDATE.unpack_from(message)
+        self.coords = [(cman_row, cman_col), (spirit_row, spirit_col)]
+        self.update_received(flag, now)
+
+    def update_received(self, flag: int, now: float) -> None:
+        self.harness.received_updates += 1
+        if self.last_update:
+            self.harness.update_intervals.append((now - self.last_update) * 1000)
+        self.last_update = now
+        self.can_move = flag == 0
+        self.updates += 1
+        if self.role != "watcher":
+            self.track_move(now)
+
+    def track_move(self, now: float) -> None:
+        player = ROLE_TO_CODE[self.role] - 1
+        if self.pending_move is not None:
+            sent_at, target = self.pending_move
+            if self.coords[player] == target:
+                self.harness.move_latencies.append((now - sent_at) * 1000)
+                self.pending_move = None
+            elif now - sent_at > self.harness.move_timeout:
+                self.pending_move = None
+        if self.pending_move is None and self.can_move and self.updates % self.harness.move_every == 0:
+            direction = self.next_direction()
+            step = DIRECTION_STEPS[direction]
+            target = (self.coords[player][0] + step[0], self.coords[player][1] + step[1])
+            if self.harness.game_map.is_walkable(target):
+                self.pending_move = (now, target)
+            self.send(MOVE.pack(OPCODES["move"], direction))
+
+    def next_direction(self) -> int:
+        script = self.harness.script
+        if not script:
+            return random.randint(0, 3)
+        direction = script[self.script_position % len(script)]
+        self.script_position += 1
+        return direction
+
+    def quit(self) -> None:
+        if not self.finished:
+            self.send(QUIT.pack(OPCODES["quit"]))
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.game_map = compile_map("map.txt")
+        self.decoder = server_decoder((len(self.game_map.point_positions) + 7) // 8)
+        self.move_every = args.move_every
+        self.move_timeout = args.move_timeout
+        self.script = [int(c) for c in args.script] if args.script else []
+        self.version = args.protocol_version
+        self.datagrams_in = 0
+        self.datagrams_out = 0
+        self.received_updates = 0
+        self.lost_updates = 0
+        self.unknown_messages = 0
+        self.legacy_violations = 0 # messages a version 0 bot received that the baseline client cannot parse
+        self.games_finished = 0 # counted per player and watcher that received an end message
+        self.errors = 0
+        self.update_intervals: list[float] = []
+        self.move_latencies: list[float] = []
+        self.bots: list[Bot] = []
+
+    async def read_server_output(self, stream: asyncio.StreamReader) -> None:
+        while True:
+            if not await stream.readline(): # read only so the server never blocks on a full pipe
+                return
+
+    def join_rate(self) -> float:
+        # All bots join from one IP, so their joins must fit both its bucket and the shared new source burst
+        return (2 * self.args.matches + self.args.watchers) / BURST_SECONDS
+
+    async def add_bot(self, role: str, match_id: Optional[int] = None) -> None:
+        loop = asyncio.get_running_loop()
+        bot = Bot(self, role, match_id)
+        await loop.create_datagram_endpoint(lambda: bot, remote_addr=("127.0.0.1", self.args.port))
+        self.bots.append(bot)
+
+    async def run(self) -> dict:
+        args = self.args
+        descriptor, tick_log = tempfile.mkstemp(prefix="cman_ticks_")
+        os.close(descriptor)
+        server = await asyncio.create_subprocess_exec(
+            sys.executable, "-u", "cman_server.py", "-p", str(args.port), "--fps", str(args.fps),
+            "--stats-interval", str(args.stats_interval), "--source-rate", str(max(SOURCE_RATE, self.join_rate())),
+            "--new-source-rate", str(max(NEW_SOURCE_RATE, self.join_rate())),
+            "--tick-log", tick_log,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        reader = asyncio.ensure_future(self.read_server_output(server.stdout))
+        try:
+            await asyncio.sleep(args.startup)
+            for _ in range(args.matches):
+                await self.add_bot("cman")
+                await self.add_bot("spirit")
+            await asyncio.sleep(0.2)
+            for k in range(args.watchers):
+                await self.add_bot("watcher", k % args.matches if args.matches else None)
+            start = time.monotonic()
+            self.datagrams_in = self.datagrams_out = 0
+            ticks_before = len(read_tick_log(tick_log))
+            await asyncio.sleep(args.duration)
+            tick_durations = read_tick_log(tick_log)[ticks_before:]
+            elapsed = time.monotonic() - start
+            datagrams_in, datagrams_out = self.datagrams_in, self.datagrams_out
+            games_finished = self.games_finished
+            for bot in self.bots:
+                bot.quit()
+            await asyncio.sleep(0.5)
+        finally:
+            server.terminate()
+            await server.wait()
+            await reader
+            for bot in self.bots:
+                bot.transport.close()
+            os.remove(tick_log)
+        expected = self.received_updates + self.lost_updates
+        return {"config": {"matches": args.matches, "watchers": args.watchers, "fps": args.fps,
+                           "duration_s": args.duration, "protocol_version": self.version,
+                           "mover": "script" if self.script else "random"},
+                "datagrams_to_server_per_s": datagrams_out / elapsed,
+                "datagrams_from_server_per_s": datagrams_in / elapsed,
+                "update_interval_ms": percentiles(self.update_intervals),
+                "move_to_update_latency_ms": percentiles(self.move_latencies),
+                "update_loss_ratio": self.lost_updates / expected if expected else 0.0,
+                "server_tick_duration_ms": percentiles(tick_durations),
+                "server_tick_overruns": sum(duration > 1000 / args.fps for duration in tick_durations),
+                "games_finished": games_finished,
+                "errors": self.errors,
+                "unknown_messages": self.unknown_messages,
+                "legacy_violations": self.legacy_violations}
+
+
+def raise_file_limit() -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test cman_server on loopback with headless clients.")
+    parser.add_argument("-p", "--port", type=int, default=14337, help="Server port (default: 14337).")
+    parser.add_argument("--matches", type=int, default=10, help="cman/spirit pairs to start (default: 10).")
+    parser.add_argument("--watchers", type=int, default=100, help="Watchers spread over the matches (default: 100).")
+    parser.add_argument("--fps", type=float, default=10, help="Server tick rate (default: 10).")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to measure (default: 10).")
+    parser.add_argument("--move-every", type=int, default=2, help="Updates between moves of a player (default: 2).")
+    parser.add_argument("--move-timeout", type=float, default=2, help="Seconds before a move counts as lost (default: 2).")
+    parser.add_argument("--script", type=str, default="",
+                        help="Directions (0-3) players cycle through instead of random moves.")
+    parser.add_argument("--protocol-version", type=int, choices=(0, 1), default=1,
+                        help="Protocol version of the bots, 0 for full frames only (default: 1).")
+    parser.add_argument("--startup", type=float, default=1, help="Seconds to wait for the server (default: 1).")
+    parser.add_argument("--stats-interval", type=float, default=1, help="Server report interval (default: 1).")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Write the JSON report here instead of stdout.")
+    args = parser.parse_args()
+    raise_file_limit()
+    report = asyncio.run(LoadTest(args).run())
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
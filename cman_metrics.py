@@ -0,0 +1,140 @@
+import bisect
+import os
+from typing import Callable, Optional
+
+# Upper bounds in seconds shared by every latency histogram
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str = "") -> list[str]:
+        prefix = labels + "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        suffix = "{" + labels + "}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.sum}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+
+class Metrics:
+    """
+    Server counters and histograms, cheap enough to stay on: counters are lists
+    indexed by opcode and histograms use a fixed set of buckets.
+    Rendered in the Prometheus text exposition format.
+    """
+    def __init__(self) -> None:
+        self.packets_in = [0] * 256
+        self.bytes_in = [0] * 256
+        self.packets_out = [0] * 256
+        self.bytes_out = [0] * 256
+        self.parse_errors: dict[str, int] = {}
+        self.handler_errors: dict[int, int] = {}
+        self.handler_seconds: dict[int, Histogram] = {}
+        self.fanout_seconds = Histogram()
+        self.rtt_seconds = Histogram()
+        self.tick_seconds: dict[float, Histogram] = {}
+        self.gauges: dict[str, tuple[str, Callable[[], float]]] = {}
+        self.counters: dict[str, tuple[str, Optional[str], Callable]] = {}
+
+    def count_in(self, opcode: int, size: int) -> None:
+        self.packets_in[opcode] += 1
+        self.bytes_in[opcode] += size
+
+    def count_out(self, opcode: int, size: int, packets: int = 1) -> None:
+        self.packets_out[opcode] += packets
+        self.bytes_out[opcode] += size * packets
+
+    def parse_error(self, kind: str) -> None:
+        self.parse_errors[kind] = self.parse_errors.get(kind, 0) + 1
+
+    def handler_error(self, opcode: int) -> None:
+        self.handler_errors[opcode] = self.handler_errors.get(opcode, 0) + 1
+
+    def observe_handler(self, opcode: int, seconds: float) -> None:
+        histogram = self.handler_seconds.get(opcode)
+        if histogram is None:
+            histogram = self.handler_seconds[opcode] = Histogram()
+        histogram.observe(seconds)
+
+    def observe_tick(self, fps: float, seconds: float) -> None:
+        histogram = self.tick_seconds.get(fps)
+        if histogram is None:
+            histogram = self.tick_seconds[fps] = Histogram()
+        histogram.observe(seconds)
+
+    def add_gauge(self, name: str, description: str, read: Callable[[], float]) -> None:
+        self.gauges[name] = (description, read)
+
+    def add_counter(self, name: str, description: str, read: Callable, label: Optional[str] = None) -> None:
+        # For counters kept elsewhere. With a label, read returns the values by label value
+        self.counters[name] = (description, label, read)
+
+    def render(self) -> str:
+        lines = []
+        for name, description, values in (("cman_packets_in_total", "Messages received by opcode.", self.packets_in),
+                                          ("cman_bytes_in_total", "Bytes received by opcode.", self.bytes_in),
+                                          ("cman_packets_out_total", "Messages sent by opcode.", self.packets_out),
+                                          ("cman_bytes_out_total", "Bytes sent by opcode.", self.bytes_out)):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} counter")
+            for opcode, value in enumerate(values):
+                if value:
+                    lines.append(f'{name}{{opcode="0x{opcode:02X}"}} {value}')
+        lines.append("# HELP cman_parse_errors_total Datagrams or messages rejected while parsing.")
+        lines.append("# TYPE cman_parse_errors_total counter")
+        for kind, value in self.parse_errors.items():
+            lines.append(f'cman_parse_errors_total{{kind="{kind}"}} {value}')
+        lines.append("# HELP cman_handler_errors_total Messages whose handler raised, by opcode.")
+        lines.append("# TYPE cman_handler_errors_total counter")
+        for opcode, value in sorted(self.handler_errors.items()):
+            lines.append(f'cman_handler_errors_total{{opcode="0x{opcode:02X}"}} {value}')
+        lines.append("# HELP cman_handler_seconds Time spent handling one message, by opcode.")
+        lines.append("# TYPE cman_handler_seconds histogram")
+        for opcode, histogram in sorted(self.handler_seconds.items()):
+            lines += histogram.render("cman_handler_seconds", f'opcode="0x{opcode:02X}"')
+        lines.append("# HELP cman_fanout_seconds Time spent sending spectator updates per tick.")
+        lines.append("# TYPE cman_fanout_seconds histogram")
+        lines += self.fanout_seconds.render("cman_fanout_seconds")
+        lines.append("# HELP cman_rtt_seconds Round trip times measured with pings.")
+        lines.append("# TYPE cman_rtt_seconds histogram")
+        lines += self.rtt_seconds.render("cman_rtt_seconds")
+        lines.append("# HELP cman_tick_seconds Duration of a game tick, by tick rate.")
+        lines.append("# TYPE cman_tick_seconds histogram")
+        for fps, histogram in sorted(self.tick_seconds.items()):
+            lines += histogram.render("cman_tick_seconds", f'fps="{fps:g}"')
+        for name, (description, label, read) in self.counters.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} counter")
+            if label is None:
+                lines.append(f"{name} {read()}")
+                continue
+            for value_label, value in read().items():
+                lines.append(f'{name}{{{label}="{value_label}"}} {value}')
+        for name, (description, read) in self.gauges.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, path: str) -> None:
+        # Written next to the target and renamed, so scrapers never see a partial file
+        temporary = path + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(self.render())
+        os.replace(temporary, path)
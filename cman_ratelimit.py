@@ -0,0 +1,107 @@
+from typing import Union
+from constants import SOURCE_RATE, NEW_SOURCE_RATE, ERROR_RATE, BURST_SECONDS, BLOCK_THRESHOLD, BLOCK_TIME, \
+    MAX_TRACKED_SOURCES
+
+
+class TokenBucket:
+    """
+    Allows rate events per second on average and up to burst at once. Tokens are
+    refilled lazily from the time of the previous call, so an idle bucket costs nothing.
+    """
+    def __init__(self, rate: float, burst: float, now: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now: float) -> bool:
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+
+class RateLimiter:
+    """
+    Decides whether a datagram is handled at all, before it is parsed. Every client
+    address has its own bucket, datagrams from addresses that are not clients yet draw
+    from a bucket per IP, so changing the source port gains nothing, and they also share
+    one more bucket, so a join flood cannot crowd out the players of running matches.
+    An IP that overruns its bucket by BLOCK_THRESHOLD datagrams within one window is
+    ignored for BLOCK_TIME seconds, except for addresses that are clients already, so a
+    flood from behind the same NAT does not drop a player. Error replies draw from a
+    bucket of their own.
+
+    Source buckets are kept as [tokens, updated, drops] lists rather than TokenBucket
+    objects, since one is looked up for every datagram received. They are keyed by
+    address for clients and by IP otherwise. Past MAX_TRACKED_SOURCES buckets, as in a
+    flood from many IPs, new IPs only draw from the shared bucket until the window ends.
+    """
+    def __init__(self, now: float, source_rate: float = SOURCE_RATE, new_source_rate: float = NEW_SOURCE_RATE) -> None:
+        self.source_rate = source_rate
+        self.source_burst = source_rate * BURST_SECONDS
+        self.sources: dict[Union[tuple[str, int], str], list] = {}
+        self.blocked: dict[str, float] = {} # source IP to the time it is let back in
+        self.new_sources = TokenBucket(new_source_rate, new_source_rate * BURST_SECONDS, now)
+        self.errors = TokenBucket(ERROR_RATE, ERROR_RATE * BURST_SECONDS, now)
+        self.dropped: dict[str, int] = {"blocked": 0, "source_rate": 0, "new_source_rate": 0}
+        self.errors_suppressed = 0
+
+    def admit(self, source: tuple[str, int], known: bool, now: float) -> bool:
+        if self.blocked and not known:
+            blocked_until = self.blocked.get(source[0])
+            if blocked_until is not None:
+                if now < blocked_until:
+                    self.dropped["blocked"] += 1
+                    return False
+                del self.blocked[source[0]]
+        key = source if known else source[0]
+        bucket = self.sources.get(key)
+        if bucket is None and (known or len(self.sources) < MAX_TRACKED_SOURCES):
+            bucket = self.sources[key] = [self.source_burst, now, 0]
+        if bucket is not None:
+            tokens = min(self.source_burst, bucket[0] + (now - bucket[1]) * self.source_rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                self.dropped["source_rate"] += 1
+                if bucket[2] >= BLOCK_THRESHOLD and not known:
+                    self.block(source[0], now)
+                return False
+            bucket[0] = tokens - 1
+        if not known and not self.new_sources.take(now):
+            self.dropped["new_source_rate"] += 1
+            return False
+        return True
+
+    def block(self, ip: str, now: float) -> None:
+        print(f"Blocking {ip} for {BLOCK_TIME} seconds")
+        self.blocked[ip] = now + BLOCK_TIME
+        del self.sources[ip]
+
+    def allow_error(self, now: float) -> bool:
+        if self.errors.take(now):
+            return True
+        self.errors_suppressed += 1
+        return False
+
+    def end_window(self, now: float) -> None:
+        """
+        Starts a new window for the block threshold and forgets sources whose bucket
+        has refilled, which would start out full anyway, and blocks that ran out.
+        """
+        rate, burst = self.source_rate, self.source_burst
+        self.sources = {source: bucket for source, bucket in self.sources.items()
+                        if bucket[0] + (now - bucket[1]) * rate < burst}
+        for bucket in self.sources.values():
+            bucket[2] = 0
+        self.blocked = {source: until for source, until in self.blocked.items() if until > now}
+
+    def report(self) -> str:
+        dropped = ", ".join(f"{reason} {count}" for reason, count in self.dropped.items())
+        return (f"Rate limit: dropped {dropped}, error replies suppressed {self.errors_suppressed}, "
+                f"{len(self.blocked)} IPs blocked")
@@ -0,0 +1,373 @@
+#!/usr/bin/python3
+import argparse
+import asyncio
+import socket
+import time
+from typing import Optional
+from cman_session import ServerClient
+from cman_reliable import ReliableChannel
+from cman_ingest import Ingest
+from cman_fanout import Destinations, Fanout
+from cman_liveness import TimerWheel
+from cman_ratelimit import RateLimiter
+from cman_game_map import compile_map
+from cman_codec import ProtocolError, client_decoder, server_decoder, JOIN, WATCH, ACK, HEARTBEAT, PONG, \
+    QUIT, KEYFRAME, DELTA, END, ERROR, PING
+from constants import OPCODES, ERRORS, PROTOCOL_VERSION, DELTA_FIELDS, MAP_PATH, MAX_DATAGRAM_SIZE, \
+    RECEIVE_BUFFER_SIZE, SEND_BUFFER_SIZE, HEARTBEAT_INTERVAL, IDLE_TIMEOUT, LIVENESS_RESOLUTION, PING_INTERVAL, \
+    RETRANSMIT_TIMEOUT
+
+# Offsets in a keyframe of the fields a delta can change
+KEYFRAME_CMAN = 4
+KEYFRAME_SPIRIT = 6
+KEYFRAME_ATTEMPTS = 8
+
+
+def read_script_inputs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Relay the updates of a match to watchers, taking them off the "
+                                                 "game server. The upstream can be the server or another relay.")
+    parser.add_argument("upstream", type=str, help="Address of the game server or relay to watch.")
+    parser.add_argument("--upstream-port", type=int, default=1337, help="Its port (default: 1337).")
+    parser.add_argument("-p", "--port", type=int, default=1338, help="Port watchers join on (default: 1338).")
+    parser.add_argument("-m", "--match", type=int, default=None,
+                        help="Match id to relay, exits after it ends (default: follow the newest match).")
+    parser.add_argument("--map", type=str, default=MAP_PATH, help=f"Map of the relayed matches (default: {MAP_PATH}).")
+    parser.add_argument("--stats-interval", type=float, default=10,
+                        help="Seconds between fan-out reports, 0 to disable (default: 10).")
+    args = parser.parse_args()
+    return args
+
+
+class Relay:
+    """
+    Watches one match of an upstream server and serves it to its own watchers, speaking
+    the same protocol as the server, so a relay can watch another relay. Deltas and
+    keyframes are forwarded as they arrive, sequence numbers included. The relay keeps
+    the state of the last update as a keyframe, which answers keyframe requests and new
+    watchers and is what version 0 watchers get their full 0x80 frames from.
+    """
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.upstream_address = (socket.gethostbyname(args.upstream), args.upstream_port)
+        self.match_id: Optional[int] = args.match
+        self.stats_interval = args.stats_interval
+        bitmap_length = (len(compile_map(args.map).point_positions) + 7) // 8
+        self.upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.upstream.connect(self.upstream_address) # datagrams from anyone else are not delivered to it
+        self.upstream.setblocking(False)
+        self.upstream_buffer = bytearray(MAX_DATAGRAM_SIZE)
+        self.upstream_decoder = server_decoder(bitmap_length)
+        self.upstream_handlers = {OPCODES["keyframe"]: self.handle_keyframe,
+                                  OPCODES["delta"]: self.handle_delta,
+                                  OPCODES["ping"]: self.handle_ping,
+                                  OPCODES["end"]: self.handle_end,
+                                  OPCODES["error"]: self.handle_upstream_error}
+        self.upstream_seen = 0.0 # monotonic time of the last datagram from upstream
+        self.upstream_heard = False # anything arrived since the last join
+        self.upstream_sent = 0.0
+        self.keyframe = bytearray(KEYFRAME.size + bitmap_length) # the state as of last_seq
+        self.last_seq: Optional[int] = None # None until a keyframe arrives
+        self.end_seq: Optional[int] = None # reliable seq of the end message of the last match, until the next keyframe
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+        self.udp_socket.bind(("0.0.0.0", args.port))
+        self.udp_socket.setblocking(False)
+        self.ingest = Ingest(self.udp_socket, self.datagram_received)
+        self.fanout = Fanout(self.udp_socket)
+        self.limiter = RateLimiter(time.monotonic())
+        self.decoder = client_decoder()
+        self.opcode_to_handler = {0x03: self.handle_ack,
+                                  0x04: self.handle_keyframe_request,
+                                  0x06: self.handle_heartbeat,
+                                  0x07: self.handle_pong,
+                                  0x0F: self.handle_quit}
+        self.received_at = 0.0
+        self.clients: dict[tuple[str, int], ServerClient] = {}
+        self.targets_dirty = True
+        self.legacy_targets: Optional[Destinations] = None
+        self.delta_targets: Optional[Destinations] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.control: Optional[ReliableChannel] = None
+        self.liveness: Optional[TimerWheel] = None
+        self.done: Optional[asyncio.Future] = None
+        self.pending_end_messages = 0
+
+    # Upstream
+
+    def send_upstream(self, message: bytes) -> None:
+        try:
+            self.upstream.send(message)
+            self.upstream_sent = time.monotonic()
+        except OSError:
+            pass # also ICMP port unreachable while the upstream is down
+
+    def join_upstream(self, rejoin: bool = False) -> None:
+        """
+        Joins as a watcher. A rejoin leaves first in the same datagram, since the upstream
+        answers a join from an address it still knows with an error.
+        """
+        self.last_seq = None
+        self.upstream_seen = time.monotonic()
+        self.upstream_heard = False
+        if self.match_id is None:
+            message = JOIN.pack(OPCODES["join"], (PROTOCOL_VERSION << 4) | 0)
+        else:
+            message = WATCH.pack(OPCODES["watch"], PROTOCOL_VERSION, self.match_id)
+        self.send_upstream(QUIT.pack(OPCODES["quit"]) + message if rejoin else message)
+
+    def check_upstream(self) -> None:
+        now = time.monotonic()
+        if not self.upstream_heard and now - self.upstream_seen >= HEARTBEAT_INTERVAL:
+            self.join_upstream(rejoin=True) # the join was lost or the upstream was not up yet, it pings us once joined
+        elif now - self.upstream_seen > IDLE_TIMEOUT:
+            print("Upstream went quiet, joining again")
+            self.join_upstream(rejoin=True)
+        elif now - self.upstream_sent >= HEARTBEAT_INTERVAL:
+            self.send_upstream(HEARTBEAT.pack(OPCODES["heartbeat"]))
+        self.loop.call_later(HEARTBEAT_INTERVAL, self.check_upstream)
+
+    def upstream_received(self) -> None:
+        while True:
+            try:
+                size = self.upstream.recv_into(self.upstream_buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue # ICMP port unreachable while the upstream is down
+            self.upstream_seen = time.monotonic()
+            self.upstream_heard = True
+            try:
+                for opcode, message in self.upstream_decoder.messages(memoryview(self.upstream_buffer)[:size]):
+                    handler = self.upstream_handlers.get(opcode)
+                    if handler is not None: # a multicast announcement stays unacknowledged, so updates stay unicast
+                        handler(message)
+            except ProtocolError:
+                pass # the rest of the datagram cannot be split
+            self.fanout.end_tick()
+
+    def handle_keyframe(self, message: memoryview) -> None:
+        self.keyframe[:] = message
+        self.last_seq = int.from_bytes(message[1:3], "big")
+        self.end_seq = None
+        self.send_update(message)
+
+    def handle_delta(self, message: memoryview) -> None:
+        _, seq, flag, mask = DELTA.unpack_from(message)
+        if self.last_seq is None or seq == self.last_seq:
+            return
+        if seq != (self.last_seq + 1) & 0xFFFF: # missed an update, forward nothing until the keyframe
+            self.last_seq = None
+            self.send_upstream(bytes([OPCODES["keyframe request"]]))
+            return
+        self.last_seq = seq
+        keyframe = self.keyframe
+        keyframe[1:4] = message[1:4]
+        i = DELTA.size
+        if mask & DELTA_FIELDS["cman"]:
+            keyframe[KEYFRAME_CMAN:KEYFRAME_CMAN + 2] = message[i:i + 2]
+            i += 2
+        if mask & DELTA_FIELDS["spirit"]:
+            keyframe[KEYFRAME_SPIRIT:KEYFRAME_SPIRIT + 2] = message[i:i + 2]
+            i += 2
+        if mask & DELTA_FIELDS["attempts"]:
+            keyframe[KEYFRAME_ATTEMPTS] = message[i]
+            i += 1
+        if mask & DELTA_FIELDS["points"]:
+            for k in range(message[i]):
+                index = int.from_bytes(message[i + 1 + 2 * k:i + 3 + 2 * k], "big")
+                keyframe[KEYFRAME.size + index // 8] |= 0x80 >> (index % 8)
+        self.send_update(message)
+
+    def handle_ping(self, message: memoryview) -> None:
+        _, timestamp, _, _ = PING.unpack(message)
+        self.send_upstream(PONG.pack(OPCODES["pong"], timestamp))
+
+    def handle_end(self, message: memoryview) -> None:
+        seq = int.from_bytes(message[-2:], "big")
+        self.send_upstream(ACK.pack(OPCODES["ack"], seq))
+        if seq == self.end_seq:
+            return # a retransmission, our ack was lost
+        self.end_seq = seq
+        print("Game ended")
+        self.last_seq = None
+        end = bytearray(message[:END.size - 2])
+        watchers = list(self.clients.values())
+        self.clients.clear()
+        self.targets_dirty = True
+        self.pending_end_messages = len(watchers)
+        for client in watchers:
+            self.control.send(end, client.address, lambda delivered: self.end_message_done())
+        if not watchers:
+            self.next_match()
+
+    def end_message_done(self) -> None:
+        self.pending_end_messages -= 1
+        if self.pending_end_messages == 0:
+            self.next_match()
+
+    def next_match(self) -> None:
+        if self.match_id is not None:
+            if not self.done.done():
+                self.done.set_result(None)
+            return
+        self.join_upstream(rejoin=True)
+
+    def handle_upstream_error(self, message: memoryview) -> None:
+        _, code, seq = ERROR.unpack(message)
+        self.send_upstream(ACK.pack(OPCODES["ack"], seq))
+        if code == 0: # the quit of a rejoin, when the upstream had already let us go
+            return
+        print(ERRORS.get(code, f"ERROR: {code}"))
+        if not self.done.done():
+            self.done.set_result(None)
+
+    # Downstream
+
+    def sendto(self, message: bytes, address: tuple[str, int]) -> None:
+        try:
+            self.udp_socket.sendto(message, address)
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def legacy_frame(self) -> bytearray:
+        return bytearray([OPCODES["game update"]]) + self.keyframe[3:]
+
+    def refresh_targets(self) -> None:
+        if not self.targets_dirty:
+            return
+        legacy, delta = [], []
+        for client in self.clients.values():
+            (legacy if client.version == 0 else delta).append(client.address)
+        self.legacy_targets = self.fanout.destinations(legacy)
+        self.delta_targets = self.fanout.destinations(delta)
+        self.targets_dirty = False
+
+    def send_update(self, message: memoryview) -> None:
+        self.refresh_targets()
+        self.fanout.send(message, self.delta_targets)
+        if self.legacy_targets:
+            self.fanout.send(self.legacy_frame(), self.legacy_targets)
+
+    def send_state(self, client: ServerClient) -> None:
+        # Brings one watcher up to date outside the stream, a no-op until the first keyframe
+        if self.last_seq is not None:
+            self.sendto(self.keyframe if client.version > 0 else self.legacy_frame(), client.address)
+
+    def send_error(self, code: int, client_address: tuple[str, int]) -> None:
+        if self.limiter.allow_error(self.received_at):
+            self.control.send(bytearray([OPCODES["error"], code]), client_address)
+
+    def add_watcher(self, client: ServerClient) -> None:
+        client.last_seen = self.received_at
+        self.clients[client.address] = client
+        self.liveness.add(client.address)
+        self.targets_dirty = True
+        self.send_state(client)
+
+    def handle_new_client(self, data: memoryview, client_address: tuple[str, int]) -> None:
+        opcode = data[0]
+        if opcode == OPCODES["watch"]:
+            _, version, match_id = WATCH.unpack(data)
+            if match_id != self.match_id: # only a relay started for one match knows which one it serves
+                self.send_error(4, client_address)
+                return
+            self.add_watcher(ServerClient(client_address, 0, version))
+        elif opcode == OPCODES["join"]:
+            _, role_byte = JOIN.unpack(data)
+            if role_byte & 0x0F != 0: # players join the game server
+                self.send_error(3, client_address)
+                return
+            self.add_watcher(ServerClient(client_address, 0, role_byte >> 4))
+        else:
+            self.send_error(0, client_address)
+
+    def handle_ack(self, client_address: tuple[str, int], data: memoryview) -> None:
+        _, seq = ACK.unpack(data)
+        self.control.ack(client_address, seq)
+
+    def handle_keyframe_request(self, client_address: tuple[str, int], data=None) -> None:
+        self.send_state(self.clients[client_address])
+
+    def handle_heartbeat(self, client_address: tuple[str, int], data=None) -> None:
+        pass # last_seen is updated for every message from a known client
+
+    def handle_pong(self, client_address: tuple[str, int], data: memoryview) -> None:
+        _, timestamp = PONG.unpack(data)
+        sample = ((int(self.received_at * 1e6) - timestamp) & 0xFFFFFFFF) / 1e6
+        if sample <= PING_INTERVAL * 10:
+            self.clients[client_address].observe_rtt(sample)
+
+    def handle_quit(self, client_address: tuple[str, int], data=None) -> None:
+        self.clients.pop(client_address, None)
+        self.targets_dirty = True
+
+    def datagram_received(self, data: memoryview, client_address: tuple[str, int], received_at: float) -> None:
+        if not self.limiter.admit(client_address, client_address in self.clients, received_at):
+            return
+        self.received_at = received_at
+        try:
+            for opcode, message in self.decoder.messages(data):
+                client = self.clients.get(client_address)
+                if client is not None:
+                    client.last_seen = received_at
+                if client is not None or opcode == OPCODES["ack"]:
+                    handler = self.opcode_to_handler.get(opcode)
+                    if handler is not None: # moves and inputs have no match here
+                        handler(client_address, message)
+                else:
+                    self.handle_new_client(message, client_address)
+        except ProtocolError:
+            pass # the rest of the datagram cannot be split
+
+    def client_deadline(self, client_address: tuple[str, int]) -> Optional[float]:
+        client = self.clients.get(client_address)
+        return client.last_seen + client.idle_timeout if client is not None else None
+
+    def retransmit_timeout(self, client_address: tuple[str, int]) -> float:
+        client = self.clients.get(client_address)
+        return client.retransmit_timeout if client is not None else RETRANSMIT_TIMEOUT
+
+    def housekeeping(self) -> None:
+        now = time.monotonic()
+        for client_address in self.liveness.advance(now):
+            print(f"Watcher {client_address[0]}:{client_address[1]} timed out")
+            self.handle_quit(client_address)
+        self.limiter.end_window(now)
+        self.loop.call_later(LIVENESS_RESOLUTION, self.housekeeping)
+
+    def send_pings(self) -> None:
+        timestamp = int(time.monotonic() * 1e6) & 0xFFFFFFFF
+        for client in self.clients.values():
+            if client.version >= 5:
+                if client.rtt is None:
+                    rtt = variation = 0xFFFF
+                else:
+                    rtt = min(round(client.rtt * 1000), 0xFFFE)
+                    variation = min(round(client.rtt_variation * 1000), 0xFFFE)
+                self.sendto(PING.pack(OPCODES["ping"], timestamp, rtt, variation), client.address)
+        self.loop.call_later(PING_INTERVAL, self.send_pings)
+
+    def report_stats(self) -> None:
+        print(f"{len(self.clients)} watchers, " + self.fanout.report())
+        self.loop.call_later(self.stats_interval, self.report_stats)
+
+    async def serve(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.done = self.loop.create_future()
+        self.control = ReliableChannel(self.loop, self.sendto, self.retransmit_timeout)
+        self.liveness = TimerWheel(int(IDLE_TIMEOUT / LIVENESS_RESOLUTION) + 1, LIVENESS_RESOLUTION,
+                                   time.monotonic(), self.client_deadline)
+        self.loop.add_reader(self.upstream, self.upstream_received)
+        self.loop.add_reader(self.udp_socket, self.ingest.drain)
+        self.join_upstream()
+        print(f"Relaying {self.upstream_address[0]}:{self.upstream_address[1]}")
+        self.loop.call_later(HEARTBEAT_INTERVAL, self.check_upstream)
+        self.loop.call_later(LIVENESS_RESOLUTION, self.housekeeping)
+        self.loop.call_later(PING_INTERVAL, self.send_pings)
+        if self.stats_interval > 0:
+            self.loop.call_later(self.stats_interval, self.report_stats)
+        await self.done
+
+
+if __name__ == "__main__":
+    asyncio.run(Relay(read_script_inputs()).serve())
@@ -0,0 +1,74 @@
+import asyncio
+from typing import Callable, Optional
+from constants import RETRANSMIT_TIMEOUT, RETRANSMIT_ATTEMPTS
+
+
+class PendingMessage:
+    def __init__(self, message: bytes, address: tuple[str, int],
+                 on_done: Optional[Callable[[bool], None]], timeout: float) -> None:
+        self.message = message
+        self.address = address
+        self.on_done = on_done
+        self.attempts = 0
+        self.timeout = timeout
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class ReliableChannel:
+    """
+    Sends sequence-numbered control messages (end of game, errors) and retransmits
+    each one with exponential backoff until the client acknowledges it or the
+    attempts run out. Everything runs on loop timers so the server keeps serving
+    other clients while messages are pending. timeout_for gives the first retransmission
+    timeout for an address, RETRANSMIT_TIMEOUT for every address when it is not given.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 sendto: Callable[[bytes, tuple[str, int]], None],
+                 timeout_for: Optional[Callable[[tuple[str, int]], float]] = None) -> None:
+        self.loop = loop
+        self.sendto = sendto
+        self.timeout_for = timeout_for
+        self.next_seq = 0
+        self.pending: dict[tuple[tuple[str, int], int], PendingMessage] = {}
+
+    def send(self, message: bytearray, address: tuple[str, int],
+             on_done: Optional[Callable[[bool], None]] = None) -> int:
+        """
+        Appends a sequence number to message and sends it to address.
+        on_done is called with True once acknowledged, or False after the last retransmission.
+        """
+        seq = self.next_seq
+        self.next_seq = (self.next_seq + 1) & 0xFFFF
+        timeout = RETRANSMIT_TIMEOUT if self.timeout_for is None else self.timeout_for(address)
+        pending = PendingMessage(bytes(message) + seq.to_bytes(2, "big"), address, on_done, timeout)
+        self.pending[(address, seq)] = pending
+        self.transmit(address, seq)
+        return seq
+
+    def transmit(self, address: tuple[str, int], seq: int) -> None:
+        pending = self.pending.get((address, seq))
+        if pending is None:
+            return
+        if pending.attempts >= RETRANSMIT_ATTEMPTS:
+            self.finish(address, seq, False)
+            return
+        try:
+            self.sendto(pending.message, address)
+        except Exception:
+            pass
+        pending.attempts += 1
+        pending.timer = self.loop.call_later(pending.timeout, self.transmit, address, seq)
+        pending.timeout *= 2
+
+    def ack(self, address: tuple[str, int], seq: int) -> bool:
+        return self.finish(address, seq, True)
+
+    def finish(self, address: tuple[str, int], seq: int, delivered: bool) -> bool:
+        pending = self.pending.pop((address, seq), None)
+        if pending is None:
+            return False
+        if pending.timer is not None:
+            pending.timer.cancel()
+        if pending.on_done is not None:
+            pending.on_done(delivered)
+        return True
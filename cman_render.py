@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+import argparse
+import ctypes
+import io
+import os
+import platform
+import sys
+import time
+from contextlib import redirect_stdout
+from typing import Optional, TextIO
+
+ESC = "\x1b["
+CLEAR_SCREEN = ESC + "2J" + ESC + "H"
+CLEAR_LINE = ESC + "K"
+STD_OUTPUT_HANDLE = -11
+ENABLE_VIRTUAL_TERMINAL_PROCESSING = 0x0004
+
+
+def enable_virtual_terminal() -> None:
+    """
+    Makes the Windows console interpret ANSI sequences, through SetConsoleMode rather than
+    a subprocess. Does nothing where the console does not support it or output is redirected.
+    """
+    try:
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.GetStdHandle(STD_OUTPUT_HANDLE)
+        mode = ctypes.c_uint32()
+        if kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+            kernel32.SetConsoleMode(handle, mode.value | ENABLE_VIRTUAL_TERMINAL_PROCESSING)
+    except (OSError, AttributeError):
+        pass
+
+
+class TerminalRenderer:
+    """
+    Draws map frames with ANSI escape sequences. The first frame is drawn in full;
+    after that only the cells and status lines that changed since the last frame
+    are written, each behind a cursor move, in one buffered write per frame.
+    """
+    def __init__(self, stream: Optional[TextIO] = None) -> None:
+        self.stream = stream if stream is not None else sys.stdout
+        self.last_frame: Optional[list[list[str]]] = None
+        self.last_status: list[str] = []
+        if platform.system() == "Windows":
+            enable_virtual_terminal()
+
+    def draw(self, frame: list[list[str]], status: Optional[list[str]] = None) -> None:
+        status = status if status is not None else []
+        out = []
+        last = self.last_frame
+        if last is None or len(last) != len(frame):
+            out.append(CLEAR_SCREEN)
+            out.append('\n'.join(''.join(row) for row in frame))
+            self.last_status = []
+        else:
+            for i, row in enumerate(frame):
+                last_row = last[i]
+                if row == last_row:
+                    continue
+                for j, cell in enumerate(row):
+                    if cell != last_row[j]:
+                        out.append(f"{ESC}{i + 1};{j + 1}H{cell}")
+        status_row = len(frame) + 1
+        for k, line in enumerate(status):
+            if k >= len(self.last_status) or self.last_status[k] != line:
+                out.append(f"{ESC}{status_row + k};1H{line}{CLEAR_LINE}")
+        for k in range(len(status), len(self.last_status)):
+            out.append(f"{ESC}{status_row + k};1H{CLEAR_LINE}")
+        out.append(f"{ESC}{status_row + len(status)};1H")
+        self.last_frame = [row[:] for row in frame]
+        self.last_status = list(status)
+        self.stream.write(''.join(out))
+        self.stream.flush()
+
+    def reset(self) -> None:
+        self.last_frame = None
+        self.last_status = []
+
+
+def benchmark(frames: int) -> None:
+    """
+    Replays a random game and prints frames per second of the legacy clear-and-reprint
+    path next to the incremental renderer, with all output sent to the null device.
+    """
+    import random
+    from cman_game import Game, Player, State
+    from cman_game_map import Map, print_map
+
+    game = Game("map.txt")
+    game.state = State.START
+    game_map = Map()
+    frame_list = []
+    for _ in range(frames):
+        game.apply_move(Player.CMAN, random.randint(0, 3))
+        game.apply_move(Player.SPIRIT, random.randint(0, 3))
+        if game.get_winner() != Player.NONE:
+            game.restart_game()
+            game.state = State.START
+        game_map.cman_coords, game_map.spirit_coords = game.get_current_players_coords()
+        game_map.set_points_bitmap(game.get_points_bytes())
+        frame_list.append(game_map.full_map)
+
+    with open(os.devnull, "w") as devnull:
+        saved_stdout = os.dup(1)
+        os.dup2(devnull.fileno(), 1) # the legacy path spawns `clear`, which writes to fd 1
+        try:
+            with redirect_stdout(devnull):
+                start = time.perf_counter()
+                for frame in frame_list:
+                    print_map(frame)
+                legacy = frames / (time.perf_counter() - start)
+        finally:
+            os.dup2(saved_stdout, 1)
+            os.close(saved_stdout)
+        renderer = TerminalRenderer(devnull)
+        start = time.perf_counter()
+        for frame in frame_list:
+            renderer.draw(frame, ["Number of times cman was caught: 0"])
+        incremental = frames / (time.perf_counter() - start)
+
+    out = io.StringIO()
+    renderer = TerminalRenderer(out)
+    for frame in frame_list:
+        renderer.draw(frame, ["Number of times cman was caught: 0"])
+    print(f"clear + reprint: {legacy:,.0f} frames/s")
+    print(f"incremental ANSI: {incremental:,.0f} frames/s, {len(out.getvalue()) / frames:.0f} bytes per frame")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the terminal map renderers.")
+    parser.add_argument("--frames", type=int, default=500, help="Frames to draw (default: 500).")
+    args = parser.parse_args()
+    benchmark(args.frames)
@@ -0,0 +1,339 @@
+#!/usr/bin/python3
+import argparse
+import asyncio
+import mmap
+import os
+import socket
+import struct
+import time
+from typing import Optional
+from cman_game import Game, Player, State
+from cman_game_map import CompiledMap, compile_map
+from cman_codec import ProtocolError, client_decoder, ACK
+from constants import FPS, OPCODES, UPDATE_FLAG_INDEX, MAX_DATAGRAM_SIZE
+
+# File layout: header, path of the map in utf-8, one byte per tick, trailer once the match ended.
+# A tick byte holds the applied cman move + 1 in the low nibble and the spirit move + 1 in the
+# high nibble, so 0 is "no move" and a byte never exceeds 0x44.
+REPLAY_MAGIC = b"CMRP"
+REPLAY_VERSION = 1
+HEADER = struct.Struct("<4sB32sHdH") # magic, version, map digest, match id, fps, map path length
+TRAILER = struct.Struct("<BbbBB") # marker, winner, lives, score, end reason
+TRAILER_MARKER = 0xFF
+END_REASONS = {"played": 0, "forfeit": 1}
+WRITE_BUFFER_SIZE = 1 << 16
+REPLAY_SUFFIX = ".cmrp"
+
+
+class ReplayWriter:
+    """
+    Appends the moves of one match to a replay file. Writes go through a large user-space
+    buffer, so a tick costs a byte copy and the disk is only touched every few thousand ticks.
+    """
+    def __init__(self, path: str, game_map: CompiledMap, match_id: int, fps: float) -> None:
+        self.path = path
+        self.file = open(path, "wb", buffering=WRITE_BUFFER_SIZE)
+        map_path = game_map.path.encode()
+        self.file.write(HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, game_map.digest, match_id, fps, len(map_path)))
+        self.file.write(map_path)
+        self.ticks = 0
+
+    def record(self, cman_move: int, spirit_move: int) -> None:
+        self.file.write(bytes(((cman_move + 1) | ((spirit_move + 1) << 4),)))
+        self.ticks += 1
+
+    def finish(self, game: Game, forfeit: bool = False) -> None:
+        if self.file.closed:
+            return
+        lives, score = game.get_game_progress()
+        reason = END_REASONS["forfeit" if forfeit else "played"]
+        self.file.write(TRAILER.pack(TRAILER_MARKER, game.get_winner(), lives, score, reason))
+        self.file.close()
+
+
+class Replay:
+    """
+    A replay file mapped into memory. Opening one reads only the header and trailer;
+    tick bytes are paged in when they are iterated.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                raise ValueError(f"{path}: too short for a replay header")
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.read_header_and_trailer()
+        except ValueError: # also UnicodeDecodeError for a damaged map path
+            self.data.close()
+            raise
+
+    def read_header_and_trailer(self) -> None:
+        path = self.path
+        magic, version, self.map_digest, self.match_id, self.fps, path_length = HEADER.unpack_from(self.data)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError(f"{path}: not a version {REPLAY_VERSION} replay")
+        self.ticks_start = HEADER.size + path_length
+        if self.ticks_start > len(self.data):
+            raise ValueError(f"{path}: too short for its map path")
+        self.map_path = bytes(self.data[HEADER.size:self.ticks_start]).decode()
+        self.ticks_end = len(self.data)
+        self.winner: Optional[Player] = None
+        self.lives = self.score = self.reason = None
+        if self.ticks_end - TRAILER.size >= self.ticks_start and self.data[self.ticks_end - TRAILER.size] == TRAILER_MARKER:
+            self.ticks_end -= TRAILER.size
+            _, winner, self.lives, self.score, self.reason = TRAILER.unpack_from(self.data, self.ticks_end)
+            self.winner = Player(winner)
+
+    def __len__(self) -> int:
+        return self.ticks_end - self.ticks_start
+
+    def finished(self) -> bool:
+        return self.winner is not None
+
+    def moves(self):
+        """
+        Yields (cman move, spirit move) for every recorded tick.
+        """
+        with memoryview(self.data) as data: # released before the mapping is closed
+            for tick in data[self.ticks_start:self.ticks_end]:
+                yield (tick & 0x0F) - 1, (tick >> 4) - 1
+
+    def load_map(self, map_path: Optional[str] = None) -> str:
+        """
+        Returns the path of a map matching the recorded digest, the recorded path by default.
+        """
+        map_path = map_path if map_path is not None else self.map_path
+        if compile_map(map_path).digest != self.map_digest:
+            raise ValueError(f"{self.path}: {map_path} is not the map this match was played on")
+        return map_path
+
+    def close(self) -> None:
+        self.data.close()
+
+
+def simulate(replay: Replay, map_path: Optional[str] = None) -> Game:
+    """
+    Re-applies every recorded tick in the server's order and returns the final game.
+    """
+    game = Game(replay.load_map(map_path))
+    game.state = State.START
+    apply_move = game.apply_move
+    try:
+        for cman_move, spirit_move in replay.moves():
+            apply_move(Player.CMAN, cman_move)
+            apply_move(Player.SPIRIT, spirit_move)
+    except IndexError: # a damaged tick byte holds a move out of range
+        raise ValueError(f"{replay.path}: tick with a move out of range") from None
+    if replay.reason == END_REASONS["forfeit"]:
+        game.declare_winner(replay.winner)
+    return game
+
+
+def verify(paths: list[str], map_path: Optional[str]) -> int:
+    failures = 0
+    ticks = 0
+    start = time.perf_counter()
+    for path in paths:
+        replay = None
+        try:
+            replay = Replay(path)
+            game = simulate(replay, map_path)
+        except (ValueError, OSError) as e:
+            print(e if isinstance(e, ValueError) else f"{path}: {e}")
+            failures += 1
+            if replay is not None:
+                replay.close()
+            continue
+        ticks += len(replay)
+        lives, score = game.get_game_progress()
+        if not replay.finished():
+            print(f"{path}: {len(replay)} ticks, no result recorded")
+        elif (game.get_winner(), lives, score) != (replay.winner, replay.lives, replay.score):
+            print(f"{path}: recorded winner {replay.winner.name} lives {replay.lives} score {replay.score}, "
+                  f"simulated winner {game.get_winner().name} lives {lives} score {score}")
+            failures += 1
+        replay.close()
+    elapsed = time.perf_counter() - start
+    print(f"Verified {len(paths)} replays, {failures} mismatches, "
+          f"{ticks} ticks in {elapsed:.3f} s ({ticks / elapsed if elapsed else 0:,.0f} ticks/s)")
+    return failures
+
+
+def scan(paths: list[str]) -> None:
+    results = {"unfinished": 0, "forfeit": 0, "unreadable": 0, Player.CMAN: 0, Player.SPIRIT: 0}
+    ticks = 0
+    longest = (0, None)
+    for path in paths:
+        try:
+            replay = Replay(path)
+        except (ValueError, OSError) as e:
+            print(e if isinstance(e, ValueError) else f"{path}: {e}")
+            results["unreadable"] += 1
+            continue
+        ticks += len(replay)
+        longest = max(longest, (len(replay), path))
+        if not replay.finished():
+            results["unfinished"] += 1
+        elif replay.reason == END_REASONS["forfeit"]:
+            results["forfeit"] += 1
+        else:
+            results[replay.winner] += 1
+        replay.close()
+    print(f"{len(paths)} replays, {ticks} ticks, longest {longest[0]} ticks ({longest[1]})")
+    print(f"cman won {results[Player.CMAN]}, spirit won {results[Player.SPIRIT]}, "
+          f"{results['forfeit']} forfeits, {results['unfinished']} unfinished, {results['unreadable']} unreadable")
+
+
+class ReplayStreamer:
+    """
+    Plays a replay to watchers as if it were a live match. Watchers join with the
+    regular join or watch messages; playback starts with the first one.
+    """
+    def __init__(self, replay: Replay, port: int, fps: Optional[float], map_path: Optional[str]) -> None:
+        # Imported here, the server's session module itself records through this module
+        from cman_session import ServerClient, Session
+        self.client_type = ServerClient
+        self.replay = replay
+        self.session = Session(replay.match_id, None, None, replay.load_map(map_path),
+                               fps if fps is not None else replay.fps)
+        self.moves = replay.moves()
+        self.decoder = client_decoder()
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.bind(("0.0.0.0", port))
+        self.udp_socket.setblocking(False)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.control = None
+        self.scheduler = None
+        self.done: Optional[asyncio.Future] = None
+
+    def sendto(self, message: bytes, address: tuple[str, int]) -> None:
+        try:
+            self.udp_socket.sendto(message, address)
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def receive(self) -> None:
+        while True:
+            try:
+                data, address = self.udp_socket.recvfrom(MAX_DATAGRAM_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                for opcode, message in self.decoder.messages(memoryview(data)):
+                    self.handle_message(opcode, message, address)
+            except ProtocolError:
+                continue
+
+    def handle_message(self, opcode: int, message: memoryview, address: tuple[str, int]) -> None:
+        known = {client.address: client for client in self.session.spectators}
+        if opcode == OPCODES["ack"]:
+            self.control.ack(address, ACK.unpack(message)[1])
+        elif opcode in (OPCODES["join"], OPCODES["watch"]) and address not in known:
+            if not self.session.game_ongoing and self.session.tick_seq: # playback already ended
+                self.control.send(bytearray([OPCODES["error"], 4]), address)
+                return
+            version = message[1] >> 4 if opcode == OPCODES["join"] else message[1]
+            self.session.add_spectator(self.client_type(address, 0, version))
+            if not self.session.game_ongoing:
+                self.session.start_game()
+                self.scheduler.start()
+        elif opcode == OPCODES["keyframe request"] and address in known:
+            self.session.keyframe_requests.add(known[address])
+        elif opcode == OPCODES["quit"] and address in known:
+            self.session.remove_spectator(known[address])
+
+    def tick(self) -> None:
+        session = self.session
+        moves = next(self.moves, None)
+        if moves is None:
+            if self.replay.reason == END_REASONS["forfeit"]:
+                session.game.declare_winner(self.replay.winner)
+            self.finish()
+            return
+        session.cman_move, session.spirit_move = moves
+        session.apply_moves()
+        now = time.monotonic()
+        if session.update_due(now):
+            session.advance_tick(now)
+            self.send_updates()
+        if session.is_game_over():
+            self.finish()
+
+    def send_updates(self) -> None:
+        session = self.session
+        for client in session.spectators:
+            if client.version == 0:
+                opcode = OPCODES["game update"]
+            elif client in session.keyframe_requests or session.is_keyframe_tick():
+                opcode = OPCODES["keyframe"]
+            else:
+                opcode = OPCODES["delta"]
+            message = session.frame(opcode)
+            message[UPDATE_FLAG_INDEX[opcode]] = 1
+            self.sendto(message, client.address)
+        session.keyframe_requests.clear()
+
+    def finish(self) -> None:
+        self.scheduler.stop()
+        self.session.game_ongoing = False
+        members = self.session.members()
+        self.session.pending_end_messages = len(members)
+        if not members:
+            self.done.set_result(None)
+        message = self.session.end_message(OPCODES["end"])
+        for client in members:
+            self.control.send(message, client.address, lambda delivered: self.end_message_done())
+
+    def end_message_done(self) -> None:
+        self.session.pending_end_messages -= 1
+        if self.session.pending_end_messages == 0:
+            self.done.set_result(None)
+
+    async def serve(self) -> None:
+        from cman_reliable import ReliableChannel
+        from cman_scheduler import TickScheduler
+        self.loop = asyncio.get_running_loop()
+        self.done = self.loop.create_future()
+        self.control = ReliableChannel(self.loop, self.sendto)
+        self.scheduler = TickScheduler(self.loop, self.session.fps, self.tick)
+        self.loop.add_reader(self.udp_socket, self.receive)
+        print(f"Streaming match {self.replay.match_id}, {len(self.replay)} ticks at {self.session.fps:g} fps, "
+              f"waiting for watchers")
+        await self.done
+        self.loop.remove_reader(self.udp_socket)
+        self.udp_socket.close()
+
+
+def replay_paths(paths: list[str]) -> list[str]:
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found += sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(REPLAY_SUFFIX))
+        else:
+            found.append(path)
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verify, summarise or stream recorded cman matches.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    verify_parser = commands.add_parser("verify", help="Re-simulate replays at full speed and compare the results.")
+    verify_parser.add_argument("paths", nargs="+", help="Replay files or directories of them.")
+    verify_parser.add_argument("--map", type=str, default=None, help="Map file to use instead of the recorded path.")
+    scan_parser = commands.add_parser("scan", help="Summarise replays from their headers and trailers.")
+    scan_parser.add_argument("paths", nargs="+", help="Replay files or directories of them.")
+    stream_parser = commands.add_parser("stream", help="Play a replay to watching clients.")
+    stream_parser.add_argument("path", help="Replay file.")
+    stream_parser.add_argument("-p", "--port", type=int, default=1337, help="Port to serve on (default: 1337).")
+    stream_parser.add_argument("--fps", type=float, default=None,
+                               help=f"Playback ticks per second (default: the recorded rate, usually {FPS}).")
+    stream_parser.add_argument("--map", type=str, default=None, help="Map file to use instead of the recorded path.")
+    args = parser.parse_args()
+    if args.command == "verify":
+        raise SystemExit(1 if verify(replay_paths(args.paths), args.map) else 0)
+    elif args.command == "scan":
+        scan(replay_paths(args.paths))
+    else:
+        asyncio.run(ReplayStreamer(Replay(args.path), args.port, args.fps, args.map).serve())
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from typing import Callable, Optional
+from constants import MAX_CATCHUP_TICKS
+
+TICK_POLICIES = ("catchup", "skip")
+
+logger = logging.getLogger(__name__)
+
+
+class TickScheduler:
+    """
+    Calls callback at a fixed rate on the loop's monotonic clock. Deadlines are
+    start + n * period, so lateness in one tick does not shift the following ones.
+
+    When a tick overruns, the "catchup" policy runs the missed ticks back to back
+    (at most MAX_CATCHUP_TICKS per wakeup) while "skip" drops them and waits for the
+    next deadline. Jitter, tick durations, overruns and skipped ticks are recorded.
+    A callback that raises is logged and counted, and the next tick still comes.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, fps: float, callback: Callable[[], None],
+                 policy: str = "catchup", max_catchup: int = MAX_CATCHUP_TICKS) -> None:
+        assert policy in TICK_POLICIES, f"unknown tick policy {policy}"
+        self.loop = loop
+        self.fps = fps
+        self.period = 1 / fps
+        self.callback = callback
+        self.policy = policy
+        self.max_catchup = max_catchup
+        self.deadline = 0.0
+        self.handle: Optional[asyncio.TimerHandle] = None
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.errors = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+        self.wakeups = 0
+        self.duration_total = 0.0
+        self.duration_max = 0.0
+        self.errors_total = 0 # never reset by report, for metrics
+
+    def start(self) -> None:
+        self.deadline = self.loop.time()
+        self.handle = self.loop.call_at(self.deadline, self.run)
+
+    def stop(self) -> None:
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def run(self) -> None:
+        now = self.loop.time()
+        jitter = now - self.deadline
+        self.wakeups += 1
+        self.jitter_total += jitter
+        if jitter > self.jitter_max:
+            self.jitter_max = jitter
+        runs = 0
+        while True:
+            start = self.loop.time()
+            try:
+                self.callback()
+            except Exception:
+                self.errors += 1
+                self.errors_total += 1
+                logger.exception("Tick at %g FPS failed", self.fps)
+            duration = self.loop.time() - start
+            self.ticks += 1
+            self.duration_total += duration
+            if duration > self.duration_max:
+                self.duration_max = duration
+            if duration > self.period:
+                self.overruns += 1
+            runs += 1
+            if self.handle is None: # stopped by the callback
+                return
+            self.deadline += self.period
+            now = self.loop.time()
+            if self.deadline > now:
+                break
+            if self.policy == "skip" or runs >= self.max_catchup:
+                missed = int((now - self.deadline) // self.period) + 1
+                self.skipped += missed
+                self.deadline += missed * self.period
+                break
+        self.handle = self.loop.call_at(self.deadline, self.run)
+
+    def report(self) -> str:
+        jitter = self.jitter_total / self.wakeups if self.wakeups else 0.0
+        duration = self.duration_total / self.ticks if self.ticks else 0.0
+        line = (f"Ticks at {self.fps:g} FPS ({self.policy}): {self.ticks} ticks, "
+                f"jitter avg {jitter * 1000:.2f} ms max {self.jitter_max * 1000:.2f} ms, "
+                f"duration avg {duration * 1000:.2f} ms max {self.duration_max * 1000:.2f} ms, "
+                f"{self.overruns} overruns, {self.skipped} skipped, {self.errors} errors")
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.errors = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+        self.wakeups = 0
+        self.duration_total = 0.0
+        self.duration_max = 0.0
+        return line
@@ -1,259 +1,698 @@
 #!/usr/bin/python3
-import socket
+import asyncio
 import argparse
-from typing import Optional
-from cman_game import Game, MAX_ATTEMPTS, Player, State
+import ipaddress
+import logging
+import os
+import socket
 import time
-from constants import frame_duration, OPCODES
-import select
-
-
-def read_script_inputs() -> int:
+from collections import deque
+from typing import Optional
+from cman_game import Player
+from cman_session import ServerClient, Session, bot_client
+from cman_reliable import ReliableChannel
+from cman_ingest import Ingest
+from cman_fanout import Fanout
+from cman_scheduler import TickScheduler, TICK_POLICIES
+from cman_metrics import Metrics
+from cman_liveness import TimerWheel
+from cman_bots import BOTS
+from cman_game_map import compile_map
+from cman_codec import ProtocolError, client_decoder, check_direction, JOIN, WATCH, ACK, INPUT, INPUT_ECHO, \
+    PING, PONG
+from cman_replay import ReplayWriter, REPLAY_SUFFIX
+from cman_ratelimit import RateLimiter, TokenBucket
+from cman_checkpoint import encode as encode_checkpoint, decode as decode_checkpoint, write_file, CheckpointError
+from constants import FPS, OPCODES, MAX_MATCH_ID, RECEIVE_BUFFER_SIZE, SEND_BUFFER_SIZE, UPDATE_FLAG_INDEX, \
+    IDLE_TIMEOUT, LIVENESS_RESOLUTION, MOVE_RATE, PROTOCOL_VERSION, BOT_WAIT, \
+    MAP_PATH, CHECKPOINT_INTERVAL, SOURCE_RATE, NEW_SOURCE_RATE, RATE_WINDOW, PING_INTERVAL, RETRANSMIT_TIMEOUT, \
+    ERROR_LOG_RATE, BURST_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def read_script_inputs() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Run the server script.")
     parser.add_argument("-p", "--port", type=int, default=1337,
                         help="Specify the port to run the server on (default: 1337).")
+    parser.add_argument("--stats-interval", type=float, default=10,
+                        help="Seconds between ingest and fan-out reports, 0 to disable (default: 10).")
+    parser.add_argument("--fps", type=float, default=FPS,
+                        help=f"Game ticks per second for new matches (default: {FPS}).")
+    parser.add_argument("--tick-policy", choices=TICK_POLICIES, default="catchup",
+                        help="What to do with ticks missed after an overrun (default: catchup).")
+    parser.add_argument("--metrics-file", type=str, default=None,
+                        help="Periodically write Prometheus text metrics to this file.")
+    parser.add_argument("--metrics-interval", type=float, default=15,
+                        help="Seconds between metrics file writes (default: 15).")
+    parser.add_argument("--tick-log", type=str, default=None,
+                        help="Append the duration of every tick in ms to this file, one per line.")
+    parser.add_argument("--admin-socket", type=str, default=None,
+                        help="UNIX socket path that answers every connection with the current metrics.")
+    parser.add_argument("--multicast", type=str, default=None, metavar="GROUP:PORT",
+                        help="Serve watchers over IP multicast, match n uses group GROUP + n (e.g. 239.255.0.0:1338).")
+    parser.add_argument("--input-mode", choices=("tick", "immediate"), default="tick",
+                        help="tick applies each player's latest direction every tick, immediate applies queued "
+                             "moves as they arrive and sends the new state right away (default: tick).")
+    parser.add_argument("--move-rate", type=float, default=MOVE_RATE,
+                        help=f"Moves per second per player in immediate input mode (default: {MOVE_RATE}).")
+    parser.add_argument("--bot-wait", type=float, default=BOT_WAIT,
+                        help="Seconds a player waits for an opponent before a server bot takes the other role, "
+                             f"negative to never use bots (default: {BOT_WAIT}).")
+    parser.add_argument("--record-dir", type=str, default=None,
+                        help="Record every match as a replay file in this directory, see cman_replay.py.")
+    parser.add_argument("--source-rate", type=float, default=SOURCE_RATE,
+                        help=f"Datagrams per second accepted from one address (default: {SOURCE_RATE}).")
+    parser.add_argument("--new-source-rate", type=float, default=NEW_SOURCE_RATE,
+                        help="Datagrams per second accepted from all addresses that are not clients yet "
+                             f"(default: {NEW_SOURCE_RATE}).")
+    parser.add_argument("--checkpoint", type=str, default=None,
+                        help="Periodically save the live matches to this file and resume them from it on startup.")
+    parser.add_argument("--checkpoint-interval", type=float, default=CHECKPOINT_INTERVAL,
+                        help=f"Seconds between checkpoint writes (default: {CHECKPOINT_INTERVAL}).")
     args = parser.parse_args()
-    return args.port
-
-class ServerClient:
-    def __init__(self, address: tuple[str, int], role: int) -> None:
-        self.address = address
-        self.role = role
-
-    def __hash__(self):
-        return hash(self.address)
-
-    def __eq__(self, other: "ServerClient"):
-        return self.address == other.address
+    return args
 
 
 class Server:
     def __init__(self) -> None:
         print("Server started")
-        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.port = read_script_inputs()
+        args = read_script_inputs()
+        self.port = args.port
+        self.stats_interval = args.stats_interval
+        self.fps = args.fps
+        self.tick_policy = args.tick_policy
+        self.immediate_input = args.input_mode == "immediate"
+        self.move_rate = args.move_rate
+        self.bot_wait = args.bot_wait
+        self.schedulers: dict[float, TickScheduler] = {}
+        self.metrics_file = args.metrics_file
+        self.metrics_interval = args.metrics_interval
+        # Line buffered, so the samples are there for a load test that terminates the server
+        self.tick_log = open(args.tick_log, "a", buffering=1) if args.tick_log is not None else None
+        self.admin_socket = args.admin_socket
+        self.record_dir = args.record_dir
+        self.checkpoint = args.checkpoint
+        self.checkpoint_interval = args.checkpoint_interval
+        self.checkpoint_writing = False
+        self.last_checkpoint: Optional[bytes] = None
+        if self.record_dir is not None:
+            os.makedirs(self.record_dir, exist_ok=True)
+        self.metrics = Metrics()
+        self.limiter = RateLimiter(time.monotonic(), args.source_rate, args.new_source_rate)
+        self.session_errors = 0
+        self.error_log = TokenBucket(ERROR_LOG_RATE, ERROR_LOG_RATE * BURST_SECONDS, time.monotonic())
+        self.multicast_base: Optional[tuple[ipaddress.IPv4Address, int]] = None
+        if args.multicast is not None:
+            group, group_port = args.multicast.rsplit(":", 1)
+            self.multicast_base = (ipaddress.IPv4Address(group), int(group_port))
         self.server_address = ("0.0.0.0", self.port)
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
         self.udp_socket.bind(self.server_address)
-        self.cman_player:Optional[ServerClient] = None
-        self.spirit_player:Optional[ServerClient] = None
-        self.spectators: list[ServerClient] = []
-        self.game = Game("map.txt")
-        self.clients = {}
-        self.spirit_move = -1
-        self.cman_move = -1
-        self.game_ongoing = False
+        self.udp_socket.setblocking(False)
+        self.ingest = Ingest(self.udp_socket, self.datagram_received)
+        self.fanout = Fanout(self.udp_socket, self.metrics)
+        self.received_at = 0.0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.control: Optional[ReliableChannel] = None
+        self.sessions: dict[int, Session] = {}
+        self.cman_queue: deque[ServerClient] = deque()
+        self.spirit_queue: deque[ServerClient] = deque()
+        self.pending_spectators: list[ServerClient] = []
+        self.clients: dict[tuple[str, int], ServerClient] = {}
+        self.liveness: Optional[TimerWheel] = None
+        self.next_match_id = 0
+        self.opcode_to_handler = {0x00: self.handle_repeated_join,
+                                  0x01: self.handle_movement,
+                                  0x02: self.handle_watch_request,
+                                  0x03: self.handle_ack,
+                                  0x04: self.handle_keyframe_request,
+                                  0x05: self.handle_input,
+                                  0x06: self.handle_heartbeat,
+                                  0x07: self.handle_pong,
+                                  0x0F: self.handle_quit}
+        self.decoder = client_decoder()
+
+    def sendto(self, message: bytes, address: tuple[str, int], opcode: Optional[int] = None) -> None:
+        # opcode names the datagram in the metrics when it does not start with its main message
+        try:
+            self.udp_socket.sendto(message, address)
+            self.metrics.count_out(message[0] if opcode is None else opcode, len(message))
+        except (BlockingIOError, InterruptedError):
+            pass # send buffer full, the datagram is lost like any other on UDP
 
+    def send_error(self, code: int, client_address: tuple[str, int]) -> None:
+        if not self.limiter.allow_error(self.received_at):
+            return
+        message = bytearray([OPCODES["error"], code])
+        self.control.send(message, client_address)
 
-    def handle_new_client(self, data: bytes, client_address: tuple[str, int]) -> None:
+    def handle_new_client(self, data: memoryview, client_address: tuple[str, int]) -> None:
         opcode = data[0]
-        message = bytearray([OPCODES["error"]])
+        if opcode == OPCODES["watch"]:
+            _, version, match_id = WATCH.unpack(data)
+            self.handle_watch(ServerClient(client_address, 0, version), match_id)
+            return
         if opcode != OPCODES["join"]: # Bad opcode
-            message.append(0)
-            self.udp_socket.sendto(message, client_address)
+            self.send_error(0, client_address)
             return
 
-        desired_role = data[1]
-        client = ServerClient(client_address, desired_role)
+        _, role_byte = JOIN.unpack(data)
+        desired_role = role_byte & 0x0F
+        client = ServerClient(client_address, desired_role, role_byte >> 4)
 
         if desired_role == 0:
-            self.clients[client_address] = client
-            self.spectators.append(client)
+            self.register_client(client)
+            newest = self.newest_session()
+            if newest is None:
+                self.pending_spectators.append(client)
+            else:
+                self.attach_spectator(newest, client)
             return
 
         elif desired_role == 1:
-            if self.cman_player is not None:# role taken
-                message.append(10)
-                self.udp_socket.sendto(message, client_address)
-                return
-            self.clients[client_address] = client
-            self.cman_player = client
+            self.register_client(client)
+            client.queued_at = self.received_at
+            self.cman_queue.append(client)
             print("Cman connected")
-            if self.spirit_player is not None:
-                self.start_game()
 
         elif desired_role == 2:
-            if self.spirit_player is not None: # role taken
-                message.append(10)
-                self.udp_socket.sendto(message, client_address)
-                return
-            self.clients[client_address] = client
-            self.spirit_player = client
+            self.register_client(client)
+            client.queued_at = self.received_at
+            self.spirit_queue.append(client)
             print("Spirit connected")
-            if self.cman_player is not None:
-                self.start_game()
 
         else: # incorrect desired role
-            message.append(3)
-            self.udp_socket.sendto(message, client_address)
+            self.send_error(3, client_address)
             return
-
-    def start_game(self):
-        self.game.state = State.START
-        print("Starting game")
-        self.game_ongoing = True
-
-    def is_game_over(self) -> bool:
-        winner = self.game.get_winner()
-        return winner != Player.NONE
-
-    def append_points_as_bits(self, message: bytearray):
-        points_dict = self.game.points
-        bit_values = []
-        for key, value in points_dict.items():
-            bit_values.append(1 - value)
-        for i in range(0, 40, 8):
-            byte_value = 0
-            for j in range(8):
-                if i + j < 40:
-                    byte_value |= (bit_values[i + j] << (7 - j))
-            message.append(byte_value)
-
-    def append_game_state_to_message(self, message: bytearray):
-        coords = self.game.get_current_players_coords()
-        for player_coords in coords:
-            message.append(player_coords[0])
-            message.append(player_coords[1])
-        attempts = MAX_ATTEMPTS - self.game.get_game_progress()[0]
-        message.append(attempts)
-        self.append_points_as_bits(message)
-
-    def send_message_to_spectators(self, message: bytearray):
-        for spectator in self.spectators:
-            address = spectator.address
-            self.udp_socket.sendto(message, address)
-
-    def send_message_to_players(self, message: bytearray):
-        if self.cman_player is not None:
-            self.udp_socket.sendto(message, self.cman_player.address)
-        if self.spirit_player is not None:
-            self.udp_socket.sendto(message, self.spirit_player.address)
-
-    def finish_game(self):
-        print("Game ended")
-        winner = self.game.get_winner() + 1
-        lives, score = self.game.get_game_progress()
-        captures = MAX_ATTEMPTS - lives
-        message = bytearray([OPCODES["end"], winner, captures, score])
-
-        readable, _, _ = select.select([self.udp_socket], [], [], 0.5)
-        if readable: #Flush residual packets
-            data, _ = self.udp_socket.recvfrom(1024)
-        for i in range(10):
-            try:
-                print("Sending ending message")
-                self.send_message_to_players(message)
-                self.send_message_to_spectators(message)
-
-            except Exception:
-                pass
-            time.sleep(1)
-        self.cman_player = None
-        self.spirit_player = None
-        self.spectators = []
-        self.game = Game("map.txt")
-        self.clients = {}
-        self.spirit_move = -1
-        self.cman_move = -1
-        self.game_ongoing = False
-        self.run()
-
-    def send_game_updates(self) -> None:
-
-        cman_address = self.cman_player.address
-        spirit_address = self.spirit_player.address
-        self.game.apply_move(Player.CMAN, self.cman_move)
-        self.game.apply_move(Player.SPIRIT, self.spirit_move)
-        can_move = self.game.can_move(self.cman_player.role - 1)
-        message = bytearray([OPCODES["game update"], int(not can_move)])
-        self.append_game_state_to_message(message)
-        self.udp_socket.sendto(message, cman_address)
-        can_move = self.game.can_move(self.spirit_player.role - 1)
-        message[1] = int(not can_move)
-        self.udp_socket.sendto(message, spirit_address)
-        message[1] = 1
-        self.send_message_to_spectators(message)
-        if self.is_game_over():
-            self.finish_game()
-
+        self.pair_queued_players()
+
+    def register_client(self, client: ServerClient) -> None:
+        client.last_seen = self.received_at
+        self.clients[client.address] = client
+        self.liveness.add(client.address)
+
+    def client_deadline(self, client_address: tuple[str, int]) -> Optional[float]:
+        client = self.clients.get(client_address)
+        return client.last_seen + client.idle_timeout if client is not None else None
+
+    def evict_idle_clients(self) -> None:
+        for client_address in self.liveness.advance(time.monotonic()):
+            print(f"Client {client_address[0]}:{client_address[1]} timed out")
+            self.handle_quit(client_address)
+
+    def handle_watch(self, client: ServerClient, match_id: int) -> None:
+        session = self.sessions.get(match_id)
+        if session is None:
+            self.send_error(4, client.address)
+            return
+        if client.address in self.clients:
+            self.detach_spectator(client)
+        self.register_client(client)
+        self.attach_spectator(session, client)
+
+    def newest_session(self) -> Optional[Session]:
+        for session in reversed(self.sessions.values()):
+            if session.game_ongoing:
+                return session
+        return None
+
+    def allocate_match_id(self) -> int:
+        while self.next_match_id in self.sessions:
+            self.next_match_id = (self.next_match_id + 1) % (MAX_MATCH_ID + 1)
+        match_id = self.next_match_id
+        self.next_match_id = (self.next_match_id + 1) % (MAX_MATCH_ID + 1)
+        return match_id
+
+    def pair_queued_players(self) -> None:
+        while self.cman_queue and self.spirit_queue:
+            if len(self.sessions) > MAX_MATCH_ID:
+                return
+            self.open_session(self.cman_queue.popleft(), self.spirit_queue.popleft())
+
+    def pair_with_bots(self, now: float) -> None:
+        # Only the longest waiting player of each queue is looked at
+        for queue, bot_role in ((self.cman_queue, 2), (self.spirit_queue, 1)):
+            while queue and now - queue[0].queued_at >= self.bot_wait and len(self.sessions) <= MAX_MATCH_ID:
+                bot = bot_client(BOTS[bot_role - 1](compile_map(MAP_PATH)), bot_role, PROTOCOL_VERSION)
+                player = queue.popleft()
+                if bot_role == 2:
+                    session = self.open_session(player, bot)
+                else:
+                    session = self.open_session(bot, player)
+                print(f"Game {session.match_id} uses a bot")
+
+    def open_session(self, cman_player: ServerClient, spirit_player: ServerClient) -> Session:
+        session = Session(self.allocate_match_id(), cman_player, spirit_player, MAP_PATH, fps=self.fps,
+                          immediate=self.immediate_input, move_rate=self.move_rate)
+        self.scheduler_for(session.fps)
+        self.sessions[session.match_id] = session
+        if self.record_dir is not None:
+            self.start_recording(session)
+        if self.multicast_base is not None:
+            group, group_port = self.multicast_base
+            session.multicast_group = (str(group + session.match_id), group_port)
+        for spectator in self.pending_spectators:
+            self.attach_spectator(session, spectator)
+        self.pending_spectators = []
+        self.start_game(session)
+        return session
+
+    def start_recording(self, session: Session) -> None:
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-match{session.match_id}{REPLAY_SUFFIX}"
+        try:
+            session.recorder = ReplayWriter(os.path.join(self.record_dir, name), session.game.map,
+                                            session.match_id, session.fps)
+        except OSError as e:
+            print(f"Could not record game {session.match_id}: {e}")
+
+    def start_game(self, session: Session):
+        session.start_game()
+        print(f"Starting game {session.match_id}")
+
+    def attach_spectator(self, session: Session, client: ServerClient) -> None:
+        session.add_spectator(client)
+        if session.multicast_group is None or client.version < 2:
+            return
+        group, group_port = session.multicast_group
+        message = bytearray([OPCODES["multicast"]]) + socket.inet_aton(group) + group_port.to_bytes(2, "big")
+        self.control.send(message, client.address,
+                          lambda delivered: self.multicast_announced(session, client, delivered))
+
+    def multicast_announced(self, session: Session, client: ServerClient, delivered: bool) -> None:
+        # Unicast updates continue until the watcher confirmed it joined the group
+        if delivered:
+            session.set_multicast(client)
+
+    def send_update(self, session: Session, client: ServerClient, can_move: bool) -> None:
+        if client.version == 0:
+            opcode = OPCODES["game update"]
+        elif client in session.keyframe_requests or session.is_keyframe_tick():
+            opcode = OPCODES["keyframe"]
+            session.keyframe_requests.discard(client)
+        else:
+            opcode = OPCODES["delta"]
+        message = session.frame(opcode)
+        message[UPDATE_FLAG_INDEX[opcode]] = int(not can_move)
+        if client.version >= 3: # the echo goes first, so the update is reconciled against it
+            echo = INPUT_ECHO.pack(OPCODES["input echo"], session.applied_seqs[client.role - 1])
+            self.sendto(echo + message, client.address, opcode)
+            return
+        self.sendto(message, client.address)
+
+    def send_spectator_updates(self, session: Session) -> None:
+        session.refresh_targets(self.fanout)
+        if session.legacy_targets:
+            message = session.frame(OPCODES["game update"])
+            message[UPDATE_FLAG_INDEX[OPCODES["game update"]]] = 1
+            self.fanout.send(message, session.legacy_targets)
+        opcode = OPCODES["keyframe"] if session.is_keyframe_tick() else OPCODES["delta"]
+        if session.delta_targets or session.multicast_targets:
+            message = session.frame(opcode)
+            message[UPDATE_FLAG_INDEX[opcode]] = 1
+            self.fanout.send(message, session.delta_targets)
+            self.fanout.send(message, session.multicast_targets)
+        if session.keyframe_requests:
+            if opcode != OPCODES["keyframe"]:
+                message = session.frame(OPCODES["keyframe"])
+                message[UPDATE_FLAG_INDEX[OPCODES["keyframe"]]] = 1
+                for client in session.keyframe_requests:
+                    self.sendto(message, client.address)
+            session.keyframe_requests.clear()
+
+    def finish_game(self, session: Session, forfeit: bool = False):
+        print(f"Game {session.match_id} ended")
+        session.game_ongoing = False
+        if session.recorder is not None:
+            session.recorder.finish(session.game, forfeit)
+        message = session.end_message(OPCODES["end"])
+        members = session.members()
+        session.pending_end_messages = len(members)
+        print("Sending ending message")
+        for client in members:
+            self.control.send(message, client.address,
+                              lambda delivered: self.end_message_done(session))
+
+    def end_message_done(self, session: Session) -> None:
+        session.pending_end_messages -= 1
+        if session.pending_end_messages == 0:
+            self.close_session(session)
+
+    def close_session(self, session: Session) -> None:
+        if session.input_timer is not None:
+            session.input_timer.cancel()
+        for client in session.members():
+            self.clients.pop(client.address, None)
+        self.sessions.pop(session.match_id, None)
+
+    def tick_session(self, session: Session) -> None:
+        session.run_bots()
+        if not session.immediate:
+            session.apply_moves()
+        else: # moves that came in since the last tick were applied on arrival, bots move now
+            changed, applied = session.apply_queued_moves(self.loop.time())
+            session.input_times += applied
+            self.schedule_queued_moves(session)
+        self.send_game_updates(session)
+
+    def send_game_updates(self, session: Session) -> None:
+        for received_at in session.input_times:
+            self.ingest.record_latency(received_at)
+        session.input_times.clear()
+        now = self.loop.time()
+        if not session.update_due(now): # an unchanged state is only repeated as a keepalive
+            return
+        session.advance_tick(now)
+        for player in (session.cman_player, session.spirit_player):
+            if player.bot is None:
+                self.send_update(session, player, session.game.can_move(player.role - 1))
+        self.send_spectator_updates(session)
+        if session.is_game_over():
+            self.finish_game(session)
+
+    def apply_queued_moves(self, session: Session) -> None:
+        """
+        Immediate input mode: applies the moves the rate limit allows now, sends the result
+        without waiting for the tick and wakes up again for moves still queued.
+        """
+        session.input_timer = None
+        if not session.game_ongoing:
+            return
+        changed, applied = session.apply_queued_moves(self.loop.time())
+        session.input_times += applied
+        if changed:
+            self.send_game_updates(session)
+        self.schedule_queued_moves(session)
+
+    def schedule_queued_moves(self, session: Session) -> None:
+        next_move_time = session.next_move_time()
+        if next_move_time is not None and session.game_ongoing and session.input_timer is None:
+            session.input_timer = self.loop.call_at(next_move_time, self.apply_queued_moves, session)
+
+    def detach_spectator(self, client: ServerClient) -> None:
+        client = self.clients.pop(client.address)
+        if client.match_id is None:
+            self.pending_spectators.remove(client)
+        elif client.match_id in self.sessions:
+            self.sessions[client.match_id].remove_spectator(client)
 
     def handle_quit(self, client_address: tuple[str, int], data=None) -> None:
         client = self.clients[client_address]
         if client.role == 0:
-            self.spectators.remove(client)
-            self.clients.pop(client_address)
+            self.detach_spectator(client)
             return
-        if self.game_ongoing:
+        session = self.sessions.get(client.match_id) if client.match_id is not None else None
+        if session is not None:
+            if not session.game_ongoing: # already ending, removed with its session
+                return
             if client.role == 1:
                 print("Cman disconnected")
                 winner = Player.SPIRIT
             else:
                 print("Spirit disconnected")
                 winner = Player.CMAN
-            self.game.declare_winner(winner)
-            self.finish_game()
+            session.game.declare_winner(winner)
+            self.finish_game(session, forfeit=True)
             return
         self.clients.pop(client_address)
         if client.role == 1:
             print("Cman disconnected")
-            self.cman_player = None
+            self.cman_queue.remove(client)
         if client.role == 2:
             print("Spirit disconnected")
-            self.spirit_player = None
+            self.spirit_queue.remove(client)
 
+    def handle_repeated_join(self, client_address: tuple[str, int], data=None) -> None:
+        pass # clients resend their join until the server answers, in case the rate limit dropped it
 
-    def handle_movement(self, client_address: tuple[str, int], data: bytes):
-        client = self.clients[client_address]
-        valid_directions = {0, 1, 2, 3}
-        if len(data) <= 1:
+    def handle_heartbeat(self, client_address: tuple[str, int], data=None) -> None:
+        pass # last_seen is updated for every message from a known client
+
+    def handle_pong(self, client_address: tuple[str, int], data: memoryview) -> None:
+        _, timestamp = PONG.unpack(data)
+        sample = ((int(self.received_at * 1e6) - timestamp) & 0xFFFFFFFF) / 1e6
+        if sample > PING_INTERVAL * 10: # answers a ping from long ago, or not one of ours at all
             return
-        direction = data[1]
-        if direction not in valid_directions:
+        self.clients[client_address].observe_rtt(sample)
+        self.metrics.rtt_seconds.observe(sample)
+
+    def send_pings(self) -> None:
+        """
+        Pings every client that answers them. Each ping carries the client's current round
+        trip estimate, which is all a client learns about its latency.
+        """
+        timestamp = int(time.monotonic() * 1e6) & 0xFFFFFFFF
+        for client in self.clients.values():
+            if client.version >= 5:
+                if client.rtt is None:
+                    rtt = variation = 0xFFFF # no estimate yet
+                else:
+                    rtt = min(round(client.rtt * 1000), 0xFFFE)
+                    variation = min(round(client.rtt_variation * 1000), 0xFFFE)
+                self.sendto(PING.pack(OPCODES["ping"], timestamp, rtt, variation), client.address)
+        self.loop.call_later(PING_INTERVAL, self.send_pings)
+
+    def retransmit_timeout(self, client_address: tuple[str, int]) -> float:
+        client = self.clients.get(client_address)
+        return client.retransmit_timeout if client is not None else RETRANSMIT_TIMEOUT
+
+    def handle_ack(self, client_address: tuple[str, int], data: memoryview) -> None:
+        _, seq = ACK.unpack(data)
+        self.control.ack(client_address, seq)
+
+    def handle_keyframe_request(self, client_address: tuple[str, int], data=None) -> None:
+        client = self.clients[client_address]
+        session = self.sessions.get(client.match_id) if client.match_id is not None else None
+        if session is not None:
+            session.request_keyframe(client)
+
+    def handle_watch_request(self, client_address: tuple[str, int], data: memoryview) -> None:
+        client = self.clients[client_address]
+        if client.role != 0: # players cannot switch matches
+            self.send_error(0, client_address)
             return
-        if client == self.cman_player:
-            self.cman_move = direction
+        _, client.version, match_id = WATCH.unpack(data)
+        self.handle_watch(client, match_id)
+
+    def handle_movement(self, client_address: tuple[str, int], data: memoryview):
+        client = self.clients[client_address]
+        direction = check_direction(data[1])
+        if client.match_id is None or client.match_id not in self.sessions:
             return
-        if client == self.spirit_player:
-            self.spirit_move = direction
+        self.set_move(self.sessions[client.match_id], client, direction)
+
+    def handle_input(self, client_address: tuple[str, int], data: memoryview):
+        client = self.clients[client_address]
+        _, direction, seq = INPUT.unpack(data)
+        check_direction(direction)
+        if client.match_id is None or client.match_id not in self.sessions:
             return
+        self.set_move(self.sessions[client.match_id], client, direction, seq)
 
+    def set_move(self, session: Session, client: ServerClient, direction: int, seq: Optional[int] = None) -> None:
+        session.set_move(client, direction, self.received_at, seq)
+        if session.immediate and session.input_timer is None:
+            self.apply_queued_moves(session)
 
-    def run(self):
-        inputs = [self.udp_socket]
-        opcode_to_handler = {0x01: self.handle_movement,
-                             0x0F: self.handle_quit}
-        opcode_length = {0x01: 1,
-                         0x0F: 0,
-                         0x00: 1}
-        print("Now accepting clients")
-        while True:
-            start_time = time.time()
-            readable, _, _ = select.select(inputs, [], [], frame_duration/3)
-            if readable:
+
+    def datagram_received(self, data: memoryview, client_address: tuple[str, int], received_at: float) -> None:
+        if not self.limiter.admit(client_address, client_address in self.clients, received_at):
+            return
+        self.received_at = received_at
+        try:
+            for opcode, message in self.decoder.messages(data):
+                self.metrics.count_in(opcode, len(message))
+                start = time.perf_counter()
                 try:
-                    data, client_address = self.udp_socket.recvfrom(1024)
-                    i = 0
-                    while i < len(data):
-                        opcode = data[i]
-                        i += 1
-                        command = data[i:i + opcode_length[opcode]]
-                        i += opcode_length[opcode]
-                        # client_address = (client_address[0] + "%11", client_address[1])
-                        if client_address in self.clients:
-                            if opcode in opcode_to_handler:
-                                opcode_to_handler[opcode](client_address, bytearray([opcode])+command)
-                            else:
-                                message = bytearray([OPCODES["error"], 0])
-                                self.udp_socket.sendto(message, client_address)
+                    client = self.clients.get(client_address)
+                    if client is not None:
+                        client.last_seen = received_at
+                    if client is not None or opcode == OPCODES["ack"]:
+                        if opcode in self.opcode_to_handler:
+                            self.opcode_to_handler[opcode](client_address, message)
                         else:
-                            self.handle_new_client(bytearray([opcode])+command, client_address)
+                            self.send_error(0, client_address)
+                    else:
+                        self.handle_new_client(message, client_address)
+                except ProtocolError as e:
+                    self.metrics.parse_error(e.kind)
                 except Exception:
-                    pass
-            if self.game_ongoing:
-                self.send_game_updates()
-            elapsed_time = time.time() - start_time
-            sleep_time = max(0, frame_duration - elapsed_time)
-            time.sleep(sleep_time)
+                    self.metrics.handler_error(opcode)
+                    if self.error_log.take(received_at):
+                        logger.exception("Handling opcode 0x%02X from %s:%d failed", opcode, *client_address)
+                self.metrics.observe_handler(opcode, time.perf_counter() - start)
+        except ProtocolError as e: # the rest of the datagram cannot be split
+            self.metrics.parse_error(e.kind)
+
+    def scheduler_for(self, fps: float) -> TickScheduler:
+        # Sessions sharing a tick rate are ticked together by one scheduler
+        scheduler = self.schedulers.get(fps)
+        if scheduler is None:
+            scheduler = TickScheduler(self.loop, fps, lambda: self.tick(fps), self.tick_policy)
+            self.schedulers[fps] = scheduler
+            scheduler.start()
+        return scheduler
+
+    def tick(self, fps: float) -> None:
+        start = time.perf_counter()
+        self.ingest.drain()
+        self.evict_idle_clients()
+        if self.bot_wait >= 0:
+            self.pair_with_bots(time.monotonic())
+        for session in list(self.sessions.values()):
+            if session.game_ongoing and session.fps == fps:
+                try:
+                    self.tick_session(session)
+                except Exception: # one broken match must not stop the others
+                    self.session_errors += 1
+                    if self.error_log.take(time.monotonic()):
+                        logger.exception("Tick of match %d failed", session.match_id)
+        self.metrics.fanout_seconds.observe(self.fanout.tick_time)
+        self.fanout.end_tick()
+        duration = time.perf_counter() - start
+        self.metrics.observe_tick(fps, duration)
+        if self.tick_log is not None:
+            self.tick_log.write(f"{duration * 1000:.3f}\n")
+
+    def end_rate_window(self) -> None:
+        self.limiter.end_window(time.monotonic())
+        self.loop.call_later(RATE_WINDOW, self.end_rate_window)
+
+    def report_stats(self) -> None:
+        print(self.ingest.report())
+        print(self.limiter.report())
+        print(self.fanout.report())
+        for scheduler in self.schedulers.values():
+            print(scheduler.report())
+        self.loop.call_later(self.stats_interval, self.report_stats)
+
+    def register_gauges(self) -> None:
+        self.metrics.add_gauge("cman_active_sessions", "Matches in progress or delivering their end message.",
+                               lambda: len(self.sessions))
+        self.metrics.add_gauge("cman_spectators", "Watchers attached to a match or waiting for one.",
+                               lambda: sum(len(session.spectators) for session in self.sessions.values())
+                                       + len(self.pending_spectators))
+        self.metrics.add_gauge("cman_queued_players", "Players waiting for an opponent.",
+                               lambda: len(self.cman_queue) + len(self.spirit_queue))
+        self.metrics.add_gauge("cman_clients", "Known client addresses.", lambda: len(self.clients))
+        self.metrics.add_gauge("cman_blocked_sources", "Source IPs ignored for flooding.",
+                               lambda: len(self.limiter.blocked))
+        self.metrics.add_counter("cman_rate_limited_total", "Datagrams dropped before parsing, by reason.",
+                                 lambda: self.limiter.dropped, "reason")
+        self.metrics.add_counter("cman_suppressed_errors_total", "Error replies not sent because of the reply cap.",
+                                 lambda: self.limiter.errors_suppressed)
+        self.metrics.add_gauge("cman_pending_control_messages", "Control messages waiting for an ack.",
+                               lambda: len(self.control.pending))
+        self.metrics.add_counter("cman_tick_errors_total", "Ticks whose callback raised, by tick rate.",
+                                 lambda: {f"{fps:g}": scheduler.errors_total
+                                          for fps, scheduler in self.schedulers.items()}, "fps")
+        self.metrics.add_counter("cman_session_tick_errors_total", "Match ticks that raised, the other matches went on.",
+                                 lambda: self.session_errors)
+
+    def write_metrics(self) -> None:
+        try:
+            self.metrics.write_file(self.metrics_file)
+        except OSError as e:
+            print(f"Could not write metrics: {e}")
+        self.loop.call_later(self.metrics_interval, self.write_metrics)
+
+    def write_checkpoint(self) -> None:
+        # Only the encoding runs on the loop, the file is written and synced in a worker thread
+        self.loop.call_later(self.checkpoint_interval, self.write_checkpoint)
+        if self.checkpoint_writing:
+            return
+        sessions = [session for session in self.sessions.values() if session.game_ongoing]
+        data = encode_checkpoint(compile_map(MAP_PATH), self.next_match_id, sessions,
+                                 list(self.cman_queue) + list(self.spirit_queue))
+        if data == self.last_checkpoint:
+            return
+        self.checkpoint_writing = True
+        future = self.loop.run_in_executor(None, write_file, self.checkpoint, data)
+        future.add_done_callback(lambda done: self.checkpoint_written(done, data))
+
+    def checkpoint_written(self, future: asyncio.Future, data: bytes) -> None:
+        self.checkpoint_writing = False
+        if future.exception() is not None:
+            print(f"Could not write checkpoint: {future.exception()}")
+            return
+        self.last_checkpoint = data
+
+    def restore_checkpoint(self) -> None:
+        """
+        Resumes the matches of the checkpoint file, if there is one. Their players and watchers are
+        sent a keyframe on the first tick and get a full idle timeout to show up again.
+        """
+        try:
+            with open(self.checkpoint, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            print(f"Could not read checkpoint: {e}")
+            return
+        try:
+            checkpoint = decode_checkpoint(data, MAP_PATH, compile_map(MAP_PATH))
+        except CheckpointError as e:
+            print(f"Ignoring damaged checkpoint: {e}")
+            return
+        if checkpoint is None:
+            print("Ignoring checkpoint written for another map or format")
+            return
+        self.received_at = time.monotonic()
+        for session in checkpoint.sessions:
+            self.sessions[session.match_id] = session
+            for client in session.members():
+                self.register_client(client)
+            if self.multicast_base is not None:
+                group, group_port = self.multicast_base
+                session.multicast_group = (str(group + session.match_id), group_port)
+            else: # saved by a server with --multicast, its watchers go back to unicast
+                for client in session.spectators:
+                    client.multicast = False
+            self.scheduler_for(session.fps)
+        for client in checkpoint.queued:
+            self.register_client(client)
+            client.queued_at = self.received_at
+            (self.cman_queue if client.role == 1 else self.spirit_queue).append(client)
+        self.next_match_id = checkpoint.next_match_id
+        self.last_checkpoint = data
+        print(f"Restored {len(checkpoint.sessions)} games and {len(checkpoint.queued)} queued players")
+
+    async def serve_admin(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        writer.write(self.metrics.render().encode())
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_reader(self.udp_socket, self.ingest.drain)
+        self.control = ReliableChannel(self.loop, self.sendto, self.retransmit_timeout)
+        self.liveness = TimerWheel(int(IDLE_TIMEOUT / LIVENESS_RESOLUTION) + 1, LIVENESS_RESOLUTION,
+                                   time.monotonic(), self.client_deadline)
+        self.register_gauges()
+        if self.admin_socket is not None:
+            if os.path.exists(self.admin_socket):
+                os.unlink(self.admin_socket)
+            await asyncio.start_unix_server(self.serve_admin, path=self.admin_socket)
+        if self.checkpoint is not None:
+            self.restore_checkpoint()
+            self.loop.call_later(self.checkpoint_interval, self.write_checkpoint)
+        print("Now accepting clients")
+        self.loop.call_later(RATE_WINDOW, self.end_rate_window)
+        self.loop.call_later(PING_INTERVAL, self.send_pings)
+        self.scheduler_for(self.fps)
+        if self.stats_interval > 0:
+            self.loop.call_later(self.stats_interval, self.report_stats)
+        if self.metrics_file is not None:
+            self.loop.call_later(self.metrics_interval, self.write_metrics)
+        await self.loop.create_future()
 
+    def run(self):
+        asyncio.run(self.serve())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,332 @@
+from collections import deque
+from typing import Optional
+from cman_game import Game, MAX_ATTEMPTS, Player, State
+from cman_fanout import Destinations, Fanout
+from cman_replay import ReplayWriter
+from cman_codec import GAME_UPDATE, KEYFRAME, DELTA
+from constants import FPS, OPCODES, KEYFRAME_INTERVAL, DELTA_FIELDS, IDLE_TIMEOUT, LEGACY_IDLE_TIMEOUT, \
+    INPUT_QUEUE_LENGTH, MOVE_RATE, KEEPALIVE_INTERVAL, RTT_GAIN, RTT_VARIATION_GAIN, RETRANSMIT_TIMEOUT, \
+    MIN_RETRANSMIT_TIMEOUT, MAX_RETRANSMIT_TIMEOUT
+
+
+class ServerClient:
+    def __init__(self, address: Optional[tuple[str, int]], role: int, version: int = 0) -> None:
+        self.address = address
+        self.role = role
+        self.version = version # 0 receives full 0x80 frames, 1 and up receives keyframes and deltas
+        self.match_id: Optional[int] = None
+        self.multicast = False # spectator receives its updates from the session's multicast group
+        self.last_seen = 0.0 # monotonic time of the last message from this address
+        self.queued_at = 0.0 # when a player started waiting for an opponent
+        self.bot = None # a cman_bots bot playing this role on the server, which has no address
+        self.rtt: Optional[float] = None # smoothed round trip time in seconds, None until the first pong
+        self.rtt_variation = 0.0
+
+    @property
+    def idle_timeout(self) -> float:
+        return IDLE_TIMEOUT if self.version >= 4 else LEGACY_IDLE_TIMEOUT
+
+    def observe_rtt(self, sample: float) -> None:
+        # Smoothed the way TCP does (RFC 6298), the variation doubles as the jitter estimate
+        if self.rtt is None:
+            self.rtt = sample
+            self.rtt_variation = sample / 2
+            return
+        self.rtt_variation += RTT_VARIATION_GAIN * (abs(self.rtt - sample) - self.rtt_variation)
+        self.rtt += RTT_GAIN * (sample - self.rtt)
+
+    @property
+    def retransmit_timeout(self) -> float:
+        if self.rtt is None:
+            return RETRANSMIT_TIMEOUT
+        return min(max(self.rtt + 4 * self.rtt_variation, MIN_RETRANSMIT_TIMEOUT), MAX_RETRANSMIT_TIMEOUT)
+
+    def __hash__(self):
+        return hash(self.address) if self.address is not None else object.__hash__(self)
+
+    def __eq__(self, other: "ServerClient"):
+        # Clients are the same when their addresses are, bots only equal themselves
+        return self is other or (self.address is not None and self.address == other.address)
+
+
+def bot_client(bot, role: int, version: int) -> ServerClient:
+    """
+    A player slot filled by a server bot. It has no address, so it can never be found
+    by or collide with anything keyed by client address.
+    """
+    client = ServerClient(None, role, version)
+    client.bot = bot
+    return client
+
+
+class Session:
+    def __init__(self, match_id: int, cman_player: Optional[ServerClient], spirit_player: Optional[ServerClient],
+                 map_path: str = "map.txt", fps: float = FPS, immediate: bool = False,
+                 move_rate: float = MOVE_RATE) -> None:
+        self.match_id = match_id
+        self.fps = fps
+        # In immediate mode moves are queued per player and applied as they arrive, at most
+        # move_rate per second, instead of the latest direction being applied every tick
+        self.immediate = immediate
+        self.move_interval = 1 / move_rate
+        self.input_queues: tuple[deque, deque] = (deque(maxlen=INPUT_QUEUE_LENGTH), deque(maxlen=INPUT_QUEUE_LENGTH))
+        self.next_move_times = [0.0, 0.0]
+        self.input_timer = None
+        self.game = Game(map_path)
+        self.cman_player: Optional[ServerClient] = cman_player
+        self.spirit_player: Optional[ServerClient] = spirit_player
+        self.spectators: list[ServerClient] = []
+        self.spirit_move = -1
+        self.cman_move = -1
+        self.game_ongoing = False
+        self.pending_end_messages = 0
+        self.input_times: list[float] = []
+        self.input_seqs = [0, 0] # newest input sequence number received from cman and spirit
+        self.applied_seqs = [0, 0] # input sequence numbers in effect at the last tick
+        self.tick_seq = 0
+        self.sent_coords = list(self.game.get_current_players_coords())
+        self.sent_attempts = 0
+        self.sent_eaten = 0
+        self.sent_flags: Optional[tuple[bool, bool]] = None # whether cman and spirit could move
+        self.echoed_seqs = [0, 0] # applied input sequence numbers as of the last update
+        self.sent_at = 0.0
+        self.delta_mask = 0
+        self.delta_fields = bytearray()
+        self.frames: dict[int, bytearray] = {}
+        bitmap_length = self.game.points_bytes_length
+        self.frame_buffers = {OPCODES["game update"]: bytearray(GAME_UPDATE.size + bitmap_length),
+                              OPCODES["keyframe"]: bytearray(KEYFRAME.size + bitmap_length),
+                              OPCODES["delta"]: bytearray(DELTA.size)}
+        self.keyframe_requests: set[ServerClient] = set()
+        self.recorder: Optional[ReplayWriter] = None
+        self.multicast_group: Optional[tuple[str, int]] = None
+        self.targets_dirty = True
+        self.checkpoint_members: Optional[bytes] = None # player and spectator records, see cman_checkpoint
+        self.legacy_targets: Optional[Destinations] = None
+        self.delta_targets: Optional[Destinations] = None
+        self.multicast_targets: Optional[Destinations] = None
+        for player in (cman_player, spirit_player):
+            if player is not None:
+                player.match_id = match_id
+                if player.bot is None:
+                    self.request_keyframe(player)
+
+    def request_keyframe(self, client: ServerClient) -> None:
+        if client.version >= 1: # version 0 only understands full frames
+            self.keyframe_requests.add(client)
+
+    def add_spectator(self, client: ServerClient) -> None:
+        client.match_id = self.match_id
+        client.multicast = False
+        self.spectators.append(client)
+        self.request_keyframe(client)
+        self.targets_dirty = True
+        self.checkpoint_members = None
+
+    def remove_spectator(self, client: ServerClient) -> None:
+        self.spectators.remove(client)
+        self.keyframe_requests.discard(client)
+        client.match_id = None
+        self.targets_dirty = True
+        self.checkpoint_members = None
+
+    def set_multicast(self, client: ServerClient) -> None:
+        if client.match_id == self.match_id and client in self.spectators:
+            client.multicast = True
+            self.targets_dirty = True
+            self.checkpoint_members = None
+
+    def refresh_targets(self, fanout: Fanout) -> None:
+        """
+        Rebuilds the spectator fan-out lists after the spectators changed.
+        """
+        if not self.targets_dirty:
+            return
+        legacy, delta, multicast = [], [], []
+        for client in self.spectators:
+            if client.version == 0:
+                legacy.append(client.address)
+            elif client.multicast and self.multicast_group is not None:
+                multicast = [self.multicast_group]
+            else:
+                delta.append(client.address)
+        self.legacy_targets = fanout.destinations(legacy)
+        self.delta_targets = fanout.destinations(delta)
+        self.multicast_targets = fanout.destinations(multicast)
+        self.targets_dirty = False
+
+    def members(self) -> list[ServerClient]:
+        players = [player for player in (self.cman_player, self.spirit_player)
+                   if player is not None and player.bot is None]
+        return players + self.spectators
+
+    def start_game(self) -> None:
+        self.game.state = State.START
+        self.game_ongoing = True
+
+    def is_game_over(self) -> bool:
+        winner = self.game.get_winner()
+        return winner != Player.NONE
+
+    def set_move(self, client: ServerClient, direction: int, received_at: float, seq: Optional[int] = None) -> None:
+        if client == self.cman_player:
+            self.set_player_move(Player.CMAN, direction, received_at, seq)
+        elif client == self.spirit_player:
+            self.set_player_move(Player.SPIRIT, direction, received_at, seq)
+
+    def set_player_move(self, player: Player, direction: int, received_at: Optional[float],
+                        seq: Optional[int] = None) -> None:
+        # received_at is None for moves made by bots, which are left out of input latency
+        if seq is not None:
+            if not 0 < (seq - self.input_seqs[player]) & 0xFFFF < 0x8000: # reordered or duplicated input
+                return
+        else:
+            seq = (self.input_seqs[player] + 1) & 0xFFFF
+        self.input_seqs[player] = seq
+        if self.immediate:
+            self.input_queues[player].append((seq, direction, received_at))
+            return
+        if player == Player.CMAN:
+            self.cman_move = direction
+        else:
+            self.spirit_move = direction
+        if received_at is not None:
+            self.input_times.append(received_at)
+
+    def run_bots(self) -> None:
+        for player, client in ((Player.CMAN, self.cman_player), (Player.SPIRIT, self.spirit_player)):
+            if client is not None and client.bot is not None:
+                direction = client.bot.next_move(self.game)
+                if direction >= 0 or not self.immediate: # a queued "no move" would only use up the rate limit
+                    self.set_player_move(player, direction, None)
+
+    def apply_moves(self) -> None:
+        if self.recorder is not None:
+            self.recorder.record(self.cman_move, self.spirit_move)
+        self.game.apply_move(Player.CMAN, self.cman_move)
+        self.game.apply_move(Player.SPIRIT, self.spirit_move)
+        self.applied_seqs = list(self.input_seqs)
+
+    def apply_queued_moves(self, now: float) -> tuple[bool, list[float]]:
+        """
+        Applies the queued moves each player's rate limit allows by now, one move per player
+        per step with cman first, as a tick would. Returns whether anything was applied and
+        when the applied inputs were received.
+        """
+        applied = []
+        changed = False
+        while not self.is_game_over():
+            moves = [-1, -1]
+            for player in (Player.CMAN, Player.SPIRIT):
+                queue = self.input_queues[player]
+                if queue and self.next_move_times[player] <= now:
+                    seq, moves[player], received_at = queue.popleft()
+                    self.applied_seqs[player] = seq
+                    self.next_move_times[player] = max(self.next_move_times[player], now) + self.move_interval
+                    if received_at is not None:
+                        applied.append(received_at)
+            if moves == [-1, -1]:
+                return changed, applied
+            changed = True
+            if self.recorder is not None:
+                self.recorder.record(*moves)
+            self.game.apply_move(Player.CMAN, moves[Player.CMAN])
+            self.game.apply_move(Player.SPIRIT, moves[Player.SPIRIT])
+        return changed, applied
+
+    def next_move_time(self) -> Optional[float]:
+        """
+        When the rate limit lets the next queued move through, or None with nothing queued.
+        """
+        times = [self.next_move_times[player] for player in (Player.CMAN, Player.SPIRIT) if self.input_queues[player]]
+        return min(times) if times else None
+
+    def move_flags(self) -> tuple[bool, bool]:
+        return self.game.can_move(Player.CMAN), self.game.can_move(Player.SPIRIT)
+
+    def update_due(self, now: float) -> bool:
+        """
+        Whether an update should go out now: something the recipients see changed since the
+        previous one, somebody waits for a keyframe, or nothing was sent for KEEPALIVE_INTERVAL.
+        Input echoes only count for human players, bots make a new input every tick.
+        """
+        if self.keyframe_requests or now - self.sent_at >= KEEPALIVE_INTERVAL:
+            return True
+        game = self.game
+        if list(game.get_current_players_coords()) != self.sent_coords \
+                or MAX_ATTEMPTS - game.get_game_progress()[0] != self.sent_attempts \
+                or len(game.get_eaten_points()) != self.sent_eaten or self.move_flags() != self.sent_flags:
+            return True
+        for player, client in ((Player.CMAN, self.cman_player), (Player.SPIRIT, self.spirit_player)):
+            if client is not None and client.bot is None and self.applied_seqs[player] != self.echoed_seqs[player]:
+                return True
+        return False
+
+    def advance_tick(self, now: float) -> None:
+        """
+        Starts a new update sequence number and records what changed since the previous
+        update. Only called for updates that are sent, so clients see consecutive numbers.
+        """
+        self.tick_seq = (self.tick_seq + 1) & 0xFFFF
+        self.sent_at = now
+        self.sent_flags = self.move_flags()
+        self.echoed_seqs = list(self.applied_seqs)
+        self.frames.clear()
+        mask = 0
+        fields = bytearray()
+        coords = self.game.get_current_players_coords()
+        for player, bit in ((Player.CMAN, DELTA_FIELDS["cman"]), (Player.SPIRIT, DELTA_FIELDS["spirit"])):
+            if coords[player] != self.sent_coords[player]:
+                mask |= bit
+                fields += bytes(coords[player])
+        self.sent_coords = list(coords)
+        attempts = MAX_ATTEMPTS - self.game.get_game_progress()[0]
+        if attempts != self.sent_attempts:
+            mask |= DELTA_FIELDS["attempts"]
+            fields.append(attempts)
+            self.sent_attempts = attempts
+        eaten = self.game.get_eaten_points()
+        if len(eaten) > self.sent_eaten:
+            mask |= DELTA_FIELDS["points"]
+            fields.append(len(eaten) - self.sent_eaten)
+            for index in eaten[self.sent_eaten:]:
+                fields += index.to_bytes(2, "big")
+            self.sent_eaten = len(eaten)
+        self.delta_mask = mask
+        self.delta_fields = fields
+
+    def is_keyframe_tick(self) -> bool:
+        return self.tick_seq % KEYFRAME_INTERVAL == 0
+
+    def frame(self, opcode: int) -> bytearray:
+        """
+        Returns the update of the current tick in the given format, built once per tick
+        into a buffer the session reuses. The can't-move flag byte is left for the caller
+        to set per recipient, and the message must be sent before the next tick.
+        """
+        message = self.frames.get(opcode)
+        if message is not None:
+            return message
+        message = self.frame_buffers[opcode]
+        if opcode == OPCODES["delta"]:
+            DELTA.pack_into(message, 0, opcode, self.tick_seq, 1, self.delta_mask)
+            message[DELTA.size:] = self.delta_fields
+        else:
+            (cman_row, cman_col), (spirit_row, spirit_col) = self.game.get_current_players_coords()
+            attempts = MAX_ATTEMPTS - self.game.get_game_progress()[0]
+            if opcode == OPCODES["game update"]:
+                layout = GAME_UPDATE
+                layout.pack_into(message, 0, opcode, 1, cman_row, cman_col, spirit_row, spirit_col, attempts)
+            else:
+                layout = KEYFRAME
+                layout.pack_into(message, 0, opcode, self.tick_seq, 1, cman_row, cman_col, spirit_row, spirit_col,
+                                 attempts)
+            message[layout.size:] = self.game.get_points_bytes()
+        self.frames[opcode] = message
+        return message
+
+    def end_message(self, opcode: int) -> bytearray:
+        winner = self.game.get_winner() + 1
+        lives, score = self.game.get_game_progress()
+        captures = MAX_ATTEMPTS - lives
+        return bytearray([opcode, winner, captures, score])
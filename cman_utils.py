@@ -1,27 +1,50 @@
+import queue
+import socket
 import pynput
 
 class KeyInputHandler:
     def __init__(self):
-        self.pressed_keys = []
+        # The listener thread queues keys and writes a byte to a socket pair, so the
+        # client can wait for keys and datagrams in a single select without polling
+        self.pressed_keys = queue.Queue()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
         self.listener = pynput.keyboard.Listener(on_press=self.on_press)
         self.listener.start()
 
     def on_press(self, key):
         try:
 
-            self.pressed_keys.append(key.char)
+            self.pressed_keys.put(key.char)
         except AttributeError:
 
-            self.pressed_keys.append(str(key))
+            self.pressed_keys.put(str(key))
+        try:
+            self.wakeup_writer.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass # a wakeup is already pending, or the handler was stopped
 
-    def get_pressed_keys(self):
-        # Return filtered keys or all pressed keys if no filter is provided
-        return self.pressed_keys
+    def fileno(self):
+        # Becomes readable when keys are waiting, for use with select
+        return self.wakeup_reader.fileno()
 
-    def clear_pressed_keys(self):
-        # Clear the list of pressed keys after processing
-        self.pressed_keys = []
+    def get_pressed_keys(self):
+        # Return and remove the keys pressed since the last call, in order
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        keys = []
+        while True:
+            try:
+                keys.append(self.pressed_keys.get_nowait())
+            except queue.Empty:
+                return keys
 
     def stop_listener(self):
         # Stop the listener (you can call this when the game ends or at the right time)
-        self.listener.stop()
\ No newline at end of file
+        self.listener.stop()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
@@ -1,10 +1,23 @@
-FPS = 2
+MAP_PATH = "map.txt" # map the server plays every match on
+FPS = 2 # default tick rate, the server's --fps option overrides it
+MAX_CATCHUP_TICKS = 4 # overdue ticks run back to back before the rest are skipped
 
 
 OPCODES = {"join": 0x00,
            "move": 0x01,
+           "watch": 0x02,
+           "ack": 0x03,
+           "keyframe request": 0x04,
+           "input": 0x05,
+           "heartbeat": 0x06,
+           "pong": 0x07,
            "quit": 0x0F,
            "game update": 0x80,
+           "keyframe": 0x81,
+           "delta": 0x82,
+           "multicast": 0x83,
+           "input echo": 0x84,
+           "ping": 0x85,
            "end": 0x8F,
            "error": 0xFF}
 
@@ -22,10 +35,68 @@ ERRORS = { 0: "ERROR: Wrong opcode sent to server",
            1: "ERROR: No data sent",
            2: "ERROR: Invalid directions",
            3: "ERROR: Incorrect desired role",
+           4: "ERROR: No such match",
            10: "ERROR: Role taken"}
 
 ROLE_TO_CODE = {"watcher": 0,
                 "cman": 1,
                 "spirit": 2}
 
-frame_duration = 1 / FPS
\ No newline at end of file
+MAX_MATCH_ID = 0xFFFF
+
+# Sent in the high nibble of the join role byte. 0 means full 0x80 frames only, 1 adds keyframes
+# and deltas, 2 adds multicast announcements for watchers, 3 adds sequence-numbered inputs (0x05)
+# with the last applied one echoed back (0x84) ahead of each player update, 4 sends a heartbeat (0x06)
+# after HEARTBEAT_INTERVAL seconds without sending anything else, 5 answers round trip pings (0x85)
+# with a pong (0x07).
+PROTOCOL_VERSION = 5
+KEYFRAME_INTERVAL = 10 # updates between keyframes sent to every delta client
+KEEPALIVE_INTERVAL = 1 # seconds between updates of a match where nothing changes
+
+# Offset of the can't-move flag byte in each update format
+UPDATE_FLAG_INDEX = {0x80: 1,
+                     0x81: 3,
+                     0x82: 3}
+
+# Bits of the delta field mask, fields follow in this order
+DELTA_FIELDS = {"cman": 0x01,       # row, column
+                "spirit": 0x02,     # row, column
+                "attempts": 0x04,   # times cman was caught
+                "points": 0x08}     # count, then 2 bytes per newly eaten point index
+
+INGEST_BUDGET = 256 # datagrams read per drain before yielding back to the loop
+MAX_DATAGRAM_SIZE = 1024
+RECEIVE_BUFFER_SIZE = 1 << 20
+SEND_BUFFER_SIZE = 1 << 20
+
+# Flood protection, see cman_ratelimit
+SOURCE_RATE = 60 # datagrams per second from one address, a player sends about 10
+NEW_SOURCE_RATE = 100 # datagrams per second from all addresses that are not clients yet
+ERROR_RATE = 20 # error replies per second
+ERROR_LOG_RATE = 1 # tracebacks of failed handlers logged per second, the rest are only counted
+BURST_SECONDS = 2 # each bucket holds this many seconds of its rate
+BLOCK_THRESHOLD = 200 # datagrams over its limit within one window that get an IP blocked
+BLOCK_TIME = 60 # seconds a blocked IP is ignored
+RATE_WINDOW = 1 # seconds between block threshold resets
+MAX_TRACKED_SOURCES = 65536 # source buckets kept at most, past this new IPs only draw from the shared bucket
+
+INPUT_QUEUE_LENGTH = 8 # queued moves per player in immediate input mode, the oldest is dropped when full
+MOVE_RATE = 8 # moves per second a player may make in immediate input mode
+
+BOT_WAIT = 10 # seconds a queued player waits for a human opponent before playing a server bot
+
+CHECKPOINT_INTERVAL = 1 # seconds between checkpoints of the live matches
+
+HEARTBEAT_INTERVAL = 2
+IDLE_TIMEOUT = 10 # seconds of silence before a client is dropped, players forfeit their match
+LEGACY_IDLE_TIMEOUT = 120 # for clients older than version 4, which only send when a key is pressed
+LIVENESS_RESOLUTION = 0.5 # seconds covered by one slot of the idle timer wheel
+
+PING_INTERVAL = 1 # seconds between round trip pings to each client
+RTT_GAIN = 1 / 8 # weight of a new sample in the smoothed round trip time, as in TCP
+RTT_VARIATION_GAIN = 1 / 4 # weight of a new sample in the round trip variation
+
+RETRANSMIT_TIMEOUT = 0.2 # seconds before the first retransmission, doubled after each one
+MIN_RETRANSMIT_TIMEOUT = 0.05 # bounds of the timeout derived from a client's round trip time
+MAX_RETRANSMIT_TIMEOUT = 2
+RETRANSMIT_ATTEMPTS = 6
\ No newline at end of file
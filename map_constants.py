@@ -7,7 +7,7 @@ POINT_CHAR = 'P'
 FREE_CHAR = 'F'
 PASS_CHARS = [CMAN_CHAR, SPIRIT_CHAR, POINT_CHAR, FREE_CHAR]
 WALL_CHAR = 'W'
-MAX_POINTS = 40
+MAX_POINTS = 8000 # the points bitmap of an update has to fit in a single datagram
 
 CHAR_VISUAL = {WALL_CHAR: "█",
                POINT_CHAR: "*",